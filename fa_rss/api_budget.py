@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+import psycopg
+from aiolimiter import AsyncLimiter
+from prometheus_client import Histogram, Counter
+
+from fa_rss.database.database import Database
+from fa_rss.faexport.priority import ApiPriority
+
+logger = logging.getLogger(__name__)
+
+budget_wait_time = Histogram(
+    "farss_api_budget_wait_seconds",
+    "Time FAExport API requests spent waiting for a token from the shared API budget, by priority",
+    ["priority"],
+    buckets=[0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60],
+)
+budget_unavailable = Counter(
+    "farss_api_budget_unavailable_count",
+    "Number of FAExport API requests paced by the local fallback limiter, because the shared API budget could not be reached",
+)
+
+
+class SharedApiBudget:
+    """
+    Token bucket shared by every process which makes requests to the FAExport API, held in the database, so that the
+    total load on FA stays within one budget however many servers and fetchers are running.
+    Each priority class may only take a token if enough are left for the classes above it, so when the budget is tight,
+    refreshes are held back first, then ingestion, then user initialisation, leaving interactive requests to be served
+    quickly.
+    If the database cannot be reached, requests are paced by a limiter local to this process at the budget's rate instead.
+    """
+    BUDGET_NAME = "faexport"
+    DEFAULT_RATE = 2
+    DEFAULT_BURST = 10
+    # Share of the bucket's capacity which must be left after taking a token, for higher priority requests
+    RESERVE_FRACTIONS = {
+        ApiPriority.INTERACTIVE: 0,
+        ApiPriority.USER_INIT: 0.2,
+        ApiPriority.INGEST: 0.4,
+        ApiPriority.REFRESH: 0.6,
+    }
+    MAX_POLL_SECONDS = 5
+
+    def __init__(self, db: Database, *, rate: float = DEFAULT_RATE, burst: float = DEFAULT_BURST) -> None:
+        self.db = db
+        self.rate = rate
+        self.capacity = burst
+        self.fallback_limiter = AsyncLimiter(burst, burst / rate)
+
+    async def acquire(self, priority: ApiPriority) -> None:
+        reserve = self.capacity * self.RESERVE_FRACTIONS[priority]
+        with budget_wait_time.labels(priority=priority.value).time():
+            while True:
+                try:
+                    wait = await self.db.take_api_budget_token(
+                        self.BUDGET_NAME,
+                        rate=self.rate,
+                        capacity=self.capacity,
+                        reserve=reserve,
+                    )
+                except psycopg.Error as e:
+                    # Carry on rather than stall, but keep this process within the budget's rate by itself
+                    logger.warning("Could not take a token from the shared API budget, using local limiter", exc_info=e)
+                    budget_unavailable.inc()
+                    await self.fallback_limiter.acquire()
+                    return
+                if wait is None:
+                    return
+                await asyncio.sleep(min(wait, self.MAX_POLL_SECONDS))
@@ -1,21 +1,36 @@
+import asyncio
 import json
 import logging
+import math
 import os
 import pathlib
 import sys
+from contextlib import aclosing
 from logging.handlers import TimedRotatingFileHandler
+from typing import Optional, AsyncIterator, ContextManager, Callable
 
+import aiohttp
 import tomlkit
-from aiolimiter import AsyncLimiter
 from hypercorn.middleware import DispatcherMiddleware
-from prometheus_client import make_asgi_app, Counter
-from quart import Quart, render_template, abort, make_response, Response, request
+from markupsafe import Markup
+from prometheus_client import make_asgi_app, Counter, Histogram
+from quart import Quart, render_template, abort, make_response, Response, request, stream_template, g
 
+from fa_rss.api_budget import SharedApiBudget
+from fa_rss.compression import negotiate_encoding, compress, record_bytes_saved
 from fa_rss.data_fetcher import DataFetcher
 from fa_rss.database.database import Database
+from fa_rss.database.models import FeedVersion
+from fa_rss.faexport.circuit_breaker import CircuitBreaker
 from fa_rss.faexport.client import FAExportClient
-from fa_rss.faexport.errors import FAUserDisabled, UserNotFound
-from fa_rss.feed_item import FeedItemFull, FeedItemPreview
+from fa_rss.faexport.errors import FAUserDisabled, UserNotFound, FAExportError, FAExportCircuitOpen
+from fa_rss.faexport.models import Submission, SubmissionPreview
+from fa_rss.faexport.priority import ApiPriority
+from fa_rss.feed_cache import FeedCache, FeedKey, CachedFeed
+from fa_rss.feed_item import FeedItem, FeedItemFull, FeedItemPreview
+from fa_rss.feed_requests import FeedRequestTracker
+from fa_rss.item_fragments import ItemFragmentCache
+from fa_rss.request_timing import RequestTimer
 from fa_rss.settings import Settings
 
 app = Quart(__name__, template_folder=str(pathlib.Path(__file__).parent.parent / "templates"))
@@ -28,28 +43,134 @@ gallery_new_user_count = Counter(
     "farss_server_gallery_new_user_count",
     "Number of times a new user has been initialised",
 )
+request_duration = Histogram(
+    "farss_server_request_duration_seconds",
+    "Time taken to handle requests, by endpoint and how the response was produced. Streamed responses are timed until"
+    " the response starts",
+    ["endpoint", "outcome"],
+)
 
-app_dispatch = DispatcherMiddleware({
+_path_dispatch = DispatcherMiddleware({
     "/metrics": make_asgi_app(),
     "/": app
 })
+
+
+async def app_dispatch(scope: dict, receive: Callable, send: Callable) -> None:
+    # The metrics app only handles HTTP, so lifespan events go only to the Quart app, to open and close its resources
+    if scope["type"] == "lifespan":
+        return await app(scope, receive, send)
+    return await _path_dispatch(scope, receive, send)
+
+
 app.select_jinja_autoescape = lambda filename: filename is not None and filename.endswith((".rss.jinja2", ".html.jinja2"))
 
 
 with open("config.json") as f:
     CONFIG = json.load(f)
 DB = Database(CONFIG["database"])
-BG_API = FAExportClient(
+# Settings are shared by all requests, and kept up to date by database notifications
+SETTINGS = Settings(DB, DB.notifications)
+# Preview requests are only limited by the API budget shared with the data fetcher, in which they take top priority
+PRIORITY_API = FAExportClient(
     CONFIG["faexport"]["url"],
-    limiter=AsyncLimiter(1, 1),
-    slowdown_limiter=AsyncLimiter(1, 4),
-    max_attempts=15,
+    budget=SharedApiBudget(
+        DB,
+        rate=CONFIG.get("api_budget", {}).get("requests_per_second", SharedApiBudget.DEFAULT_RATE),
+        burst=CONFIG.get("api_budget", {}).get("burst", SharedApiBudget.DEFAULT_BURST),
+    ),
+    default_priority=ApiPriority.INTERACTIVE,
+    # Preview requests have a fallback, so should fail fast while FA is down rather than tie up the server
+    circuit_breaker=CircuitBreaker(
+        "preview",
+        failure_threshold=CONFIG["faexport"].get("circuit_breaker", {}).get(
+            "failure_threshold", CircuitBreaker.DEFAULT_FAILURE_THRESHOLD
+        ),
+        reset_timeout=CONFIG["faexport"].get("circuit_breaker", {}).get(
+            "reset_timeout_seconds", CircuitBreaker.DEFAULT_RESET_TIMEOUT_SECONDS
+        ),
+    ),
+    connection_limit=CONFIG["faexport"].get("connection_limit", 20),
+    connection_limit_per_host=CONFIG["faexport"].get("connection_limit_per_host", 10),
+    request_timeout=CONFIG["faexport"].get("request_timeout_seconds", 120),
 )
-PRIORITY_API = FAExportClient(CONFIG["faexport"]["url"])
-FETCHER = DataFetcher(DB, BG_API)
-# app.add_background_task(FETCHER.run_data_watcher)
+FEED_CACHE = FeedCache(
+    CONFIG.get("feed_cache", {}).get("max_size_bytes", 50 * 1024 * 1024),
+    CONFIG.get("feed_cache", {}).get("max_age_seconds", 600),
+)
+DB.add_submission_listener(FEED_CACHE.on_submission_changed)
+# Users which are known to be initialised, learned from lookups and from the fetcher's notifications. Users are never
+# un-initialised, so their feeds can skip checking the users table from then on.
+INITIALISED_USERS: set[str] = set()
+DB.add_user_initialised_listener(INITIALISED_USERS.add)
+FEED_REQUESTS = FeedRequestTracker(DB)
+ITEM_FRAGMENTS = ItemFragmentCache(
+    app.jinja_env,
+    CONFIG.get("feed_cache", {}).get("max_item_fragment_bytes", 20 * 1024 * 1024),
+)
+# Whether to stream feeds to the client as they are rendered, rather than rendering them fully first
+STREAM_FEEDS = CONFIG.get("server", {}).get("stream_feeds", False)
+# Requests taking longer than this are written to the slow request log, with a breakdown of where the time went
+SLOW_REQUEST_THRESHOLD = CONFIG.get("server", {}).get("slow_request_threshold_seconds", 1)
+# How long a preview feed may wait on the FAExport API, before falling back to the submissions already stored
+PREVIEW_DEADLINE = CONFIG.get("server", {}).get("preview_deadline_seconds", 5)
+# How long feed readers are asked to wait before retrying, after being served a fallback preview feed
+PREVIEW_RETRY_AFTER = CONFIG.get("server", {}).get("preview_retry_after_seconds", 60)
 
 logger = logging.getLogger(__name__)
+# Slow request log. Kept apart from the FA-RSS log, as request paths contain usernames.
+slow_request_logger = logging.getLogger("slow_requests")
+
+
+async def on_notifications_reconnected() -> None:
+    # Changes may have been missed while disconnected
+    FEED_CACHE.clear()
+
+
+DB.notifications.add_reconnect_handler(on_notifications_reconnected)
+
+
+@app.before_serving
+async def startup() -> None:
+    await DB.open()
+    DB.notifications.start()
+    FEED_REQUESTS.start()
+
+
+@app.after_serving
+async def shutdown() -> None:
+    await FEED_REQUESTS.stop()
+    await DB.notifications.stop()
+    await PRIORITY_API.close()
+    await DB.close()
+
+
+@app.before_request
+async def start_request_timer() -> None:
+    g.request_timer = RequestTimer()
+
+
+@app.after_request
+async def observe_request_duration(response: Response) -> Response:
+    timer: RequestTimer = g.request_timer
+    elapsed = timer.elapsed()
+    outcome = "error" if response.status_code >= 400 else g.get("request_outcome", "none")
+    request_duration.labels(endpoint=request.endpoint or "none", outcome=outcome).observe(elapsed)
+    response.headers["Server-Timing"] = timer.server_timing_header()
+    if elapsed > SLOW_REQUEST_THRESHOLD:
+        slow_request_logger.warning(
+            "Slow request: %s %s took %.1fms (%s) %s",
+            request.method, request.full_path.rstrip("?"), elapsed * 1000, outcome, timer.breakdown(),
+        )
+    return response
+
+
+def set_request_outcome(outcome: str) -> None:
+    g.request_outcome = outcome
+
+
+def request_phase(name: str) -> ContextManager[None]:
+    return g.request_timer.phase(name)
 
 
 @app.get("/")
@@ -65,27 +186,184 @@ async def home_page():
     )
 
 
-async def render_rss(template: str, **template_args) -> Response:
-    rss_xml = await render_template(
-        template,
-        **template_args,
+async def render_rss_body(template: str, feed_items: list[FeedItem], **template_args) -> bytes:
+    with request_phase("render"):
+        rss_xml = await render_template(
+            template,
+            items=[await ITEM_FRAGMENTS.render(item) for item in feed_items],
+            **template_args,
+        )
+        return rss_xml.encode()
+
+
+def feed_etag(version: FeedVersion, encoding: Optional[str]) -> str:
+    # Strong validators must differ between content codings of the same feed
+    return version.etag if encoding is None else f"{version.etag}-{encoding}"
+
+
+def response_encoding(streamed: bool = False) -> Optional[str]:
+    # Streamed feeds are sent uncompressed
+    if streamed:
+        return None
+    return negotiate_encoding(request.accept_encodings)
+
+
+def is_not_modified(version: FeedVersion, encoding: Optional[str]) -> bool:
+    # Only the ETag is used to validate, as removing a submission from a feed changes the ETag but never its
+    # Last-Modified time, so If-Modified-Since alone could keep serving a client a stale feed
+    if request.if_none_match:
+        # Proxies may echo the tag back as weak, and If-None-Match is compared weakly
+        return request.if_none_match.contains_weak(feed_etag(version, encoding))
+    return False
+
+
+def set_validators(response: Response, version: FeedVersion, encoding: Optional[str]) -> None:
+    response.set_etag(feed_etag(version, encoding))
+    if version.last_modified is not None:
+        response.last_modified = version.last_modified
+
+
+async def not_modified_response(version: FeedVersion, encoding: Optional[str]) -> Response:
+    response = await make_response("", 304)
+    set_validators(response, version, encoding)
+    return response
+
+
+async def rss_response(body: bytes, version: Optional[FeedVersion] = None, cached_feed: Optional[CachedFeed] = None) -> Response:
+    encoding = response_encoding()
+    if version is not None and is_not_modified(version, encoding):
+        return await not_modified_response(version, encoding)
+    if encoding is not None:
+        # Cached feeds keep their compressed bodies, so that repeat polls never re-compress
+        with request_phase("compress"):
+            encoded_body = cached_feed.encoded_body(encoding) if cached_feed is not None else compress(body, encoding)
+        record_bytes_saved(body, encoded_body, encoding)
+        response = await make_response(encoded_body)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = await make_response(body)
+    response.headers['Content-Type'] = "application/rss+xml"
+    response.vary.add("Accept-Encoding")
+    if version is not None:
+        set_validators(response, version, encoding)
+    return response
+
+
+async def cached_rss_response(cached_feed: CachedFeed) -> Response:
+    return await rss_response(cached_feed.body, cached_feed.version, cached_feed)
+
+
+async def fetch_preview(username: str, gallery: str, sfw_mode: bool) -> list[SubmissionPreview]:
+    if gallery == "gallery":
+        return await PRIORITY_API.get_gallery_full(username, sfw_mode=sfw_mode)
+    return await PRIORITY_API.get_scraps_full(username, sfw_mode=sfw_mode)
+
+
+async def preview_fallback_response(
+        username: str,
+        gallery: str,
+        sfw_mode: bool,
+        feed_length: int,
+        error: Exception,
+) -> Response:
+    """
+    Serves whatever is already stored for a user who is not yet initialised, which may be nothing, when the preview
+    could not be fetched in time. Feed readers are asked to retry once initialisation has had a chance to run.
+    """
+    set_request_outcome("preview_fallback")
+    with request_phase("listing"):
+        stored_submissions = await DB.list_submissions_by_user_gallery(
+            username, gallery, limit=feed_length, sfw_mode=sfw_mode
+        )
+    response = await render_rss(
+        "gallery_feed.rss.jinja2",
+        [FeedItemFull(sub) for sub in stored_submissions],
+        username=username,
+        gallery=gallery,
     )
-    response = await make_response(rss_xml)
+    retry_after = PREVIEW_RETRY_AFTER
+    if isinstance(error, FAExportCircuitOpen):
+        retry_after = max(retry_after, error.retry_after)
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+async def render_rss(template: str, feed_items: list[FeedItem], **template_args) -> Response:
+    return await rss_response(await render_rss_body(template, feed_items, **template_args))
+
+
+async def stream_rss(
+        cache_key: FeedKey,
+        template: str,
+        submissions: AsyncIterator[Submission],
+        feed_version: FeedVersion,
+        cache_generation: int,
+        **template_args,
+) -> Response:
+    """
+    Streams the feed to the client, rendering each item as the database returns its row, then caches the full feed.
+    """
+
+    async def feed_item_fragments() -> AsyncIterator[Markup]:
+        async for submission in submissions:
+            yield await ITEM_FRAGMENTS.render(FeedItemFull(submission))
+
+    template_stream = await stream_template(template, items=feed_item_fragments(), **template_args)
+
+    async def body_chunks() -> AsyncIterator[bytes]:
+        chunks = []
+        # Ensure the database cursor is released, even if the client disconnects part way through
+        async with aclosing(submissions):
+            async for chunk in template_stream:
+                encoded_chunk = chunk.encode()
+                chunks.append(encoded_chunk)
+                yield encoded_chunk
+        FEED_CACHE.set(cache_key, b"".join(chunks), feed_version, cache_generation)
+
+    response = await make_response(body_chunks())
     response.headers['Content-Type'] = "application/rss+xml"
+    set_validators(response, feed_version, None)
     return response
 
 
 @app.get('/browse.rss')
 async def browse_feed():
     sfw_mode = request.args.get("sfw") == "1"
-    settings = Settings(DB)
-    feed_length = await settings.get_feed_length()
-    recent_submissions = await DB.list_recent_submissions(limit=feed_length, sfw_mode=sfw_mode)
+    with request_phase("feed_length"):
+        feed_length = await SETTINGS.get_feed_length()
+    cache_key = FEED_CACHE.browse_key(sfw_mode, feed_length)
+    cached_feed = FEED_CACHE.get(cache_key)
+    if cached_feed is not None:
+        set_request_outcome("cache_hit")
+        return await cached_rss_response(cached_feed)
+    # Taken before querying, so that the feed is not cached if a change to it arrives while it is being rendered
+    cache_generation = FEED_CACHE.generation
+    # The version is read before the listing, so that an edit saved in between leaves it older than the body rather
+    # than newer, and the next poll picks up the change
+    with request_phase("feed_version"):
+        feed_version = await DB.get_recent_feed_version(limit=feed_length, sfw_mode=sfw_mode)
+    encoding = response_encoding(streamed=STREAM_FEEDS)
+    if is_not_modified(feed_version, encoding):
+        set_request_outcome("not_modified")
+        return await not_modified_response(feed_version, encoding)
+    if STREAM_FEEDS:
+        set_request_outcome("streamed")
+        return await stream_rss(
+            cache_key,
+            "browse_feed.rss.jinja2",
+            DB.iter_recent_submissions(limit=feed_length, sfw_mode=sfw_mode),
+            feed_version,
+            cache_generation,
+        )
+    set_request_outcome("rendered")
+    with request_phase("listing"):
+        recent_submissions = await DB.list_recent_submissions(limit=feed_length, sfw_mode=sfw_mode)
     recent_items = [FeedItemFull(sub) for sub in recent_submissions]
-    return await render_rss(
+    body = await render_rss_body(
         "browse_feed.rss.jinja2",
-        submissions=recent_items,
+        recent_items,
     )
+    return await cached_rss_response(FEED_CACHE.set(cache_key, body, feed_version, cache_generation))
 
 
 @app.get('/user/<username>/<gallery>.rss')
@@ -94,45 +372,84 @@ async def gallery_feed(username, gallery):
         abort(404)
     sfw_mode = request.args.get("sfw") == "1"
     gallery_requests_count.labels(gallery=gallery).inc()
-    user_data = await DB.get_user(username)
-    settings = Settings(DB)
-    feed_length = await settings.get_feed_length()
-    if user_data is None:
+    FEED_REQUESTS.record(username)
+    with request_phase("feed_length"):
+        feed_length = await SETTINGS.get_feed_length()
+    cache_key = FEED_CACHE.user_key(username, gallery, sfw_mode, feed_length)
+    cached_feed = FEED_CACHE.get(cache_key)
+    if cached_feed is not None:
+        set_request_outcome("cache_hit")
+        return await cached_rss_response(cached_feed)
+    # Taken before querying, so that the feed is not cached if a change to it arrives while it is being rendered
+    cache_generation = FEED_CACHE.generation
+    if username.lower() not in INITIALISED_USERS:
+        with request_phase("get_user"):
+            user_data = await DB.get_user(username)
+        if user_data is not None:
+            INITIALISED_USERS.add(user_data.username)
+    if username.lower() not in INITIALISED_USERS:
+        set_request_outcome("preview")
         gallery_new_user_count.inc()
-        logger.info("Scheduled background task to initialise user data: %s", username)
-        app.add_background_task(FETCHER.initialise_user_data, username)
+        logger.info("Queueing job to initialise user data: %s", username)
+        with request_phase("enqueue_user_init"):
+            await DB.enqueue_user_init_job(username, DataFetcher.USER_INIT_PRIORITY_FEED_REQUEST)
         logger.info("Generating preview feed for user: %s", username)
         try:
-            if gallery == "gallery":
-                preview_submissions = await PRIORITY_API.get_gallery_full(username, sfw_mode=sfw_mode)
-            elif gallery == "scraps":
-                preview_submissions = await PRIORITY_API.get_scraps_full(username, sfw_mode=sfw_mode)
-            else:
-                abort(404)
+            with request_phase("preview_api"):
+                preview_submissions = await asyncio.wait_for(
+                    fetch_preview(username, gallery, sfw_mode),
+                    PREVIEW_DEADLINE,
+                )
         except (FAUserDisabled, UserNotFound):
             abort(404)
+        except (FAExportError, aiohttp.ClientError, TimeoutError) as e:
+            logger.warning("Could not fetch preview feed in time, falling back to stored submissions: %r", e)
+            return await preview_fallback_response(username, gallery, sfw_mode, feed_length, e)
         preview_submissions = preview_submissions[:feed_length]
+        with request_phase("known_submissions"):
+            known_submissions = await DB.get_submissions([sub.submission_id for sub in preview_submissions])
         feed_items = []
         for submission_preview in preview_submissions:
-            full_submission = await DB.get_submission(submission_preview.submission_id)
+            full_submission = known_submissions.get(submission_preview.submission_id)
             if full_submission is None:
                 feed_items.append(FeedItemPreview(submission_preview))
             else:
                 feed_items.append(FeedItemFull(full_submission))
         return await render_rss(
             "gallery_feed.rss.jinja2",
+            feed_items,
+            username=username,
+            gallery=gallery,
+        )
+    # Read before the listing, as for the browse feed
+    with request_phase("feed_version"):
+        feed_version = await DB.get_user_gallery_feed_version(username, gallery, limit=feed_length, sfw_mode=sfw_mode)
+    encoding = response_encoding(streamed=STREAM_FEEDS)
+    if is_not_modified(feed_version, encoding):
+        set_request_outcome("not_modified")
+        return await not_modified_response(feed_version, encoding)
+    if STREAM_FEEDS:
+        set_request_outcome("streamed")
+        return await stream_rss(
+            cache_key,
+            "gallery_feed.rss.jinja2",
+            DB.iter_submissions_by_user_gallery(username, gallery, limit=feed_length, sfw_mode=sfw_mode),
+            feed_version,
+            cache_generation,
             username=username,
             gallery=gallery,
-            submissions=feed_items,
         )
-    user_gallery = await DB.list_submissions_by_user_gallery(username, gallery, limit=feed_length, sfw_mode=sfw_mode)
+    set_request_outcome("rendered")
+    with request_phase("listing"):
+        user_gallery = await DB.list_submissions_by_user_gallery(username, gallery, limit=feed_length, sfw_mode=sfw_mode)
     user_items = [FeedItemFull(sub) for sub in user_gallery]
-    return await render_rss(
+    body = await render_rss_body(
         "gallery_feed.rss.jinja2",
+        user_items,
         username=username,
         gallery=gallery,
-        submissions=user_items,
     )
+    return await cached_rss_response(FEED_CACHE.set(cache_key, body, feed_version, cache_generation))
 
 
 def setup_logging() -> None:
@@ -151,6 +468,11 @@ def setup_logging() -> None:
     file_handler.setFormatter(formatter)
     fa_logger.addHandler(file_handler)
 
+    # Slow request log, with the timing breakdown of each request which went over the threshold
+    slow_handler = TimedRotatingFileHandler("logs/slow_requests.log", when="midnight")
+    slow_handler.setFormatter(formatter)
+    slow_request_logger.addHandler(slow_handler)
+
 
 setup_logging()
 
@@ -0,0 +1,44 @@
+import gzip
+import logging
+from typing import Optional
+
+import brotli
+from prometheus_client import Counter, Histogram
+from werkzeug.datastructures import Accept
+
+logger = logging.getLogger(__name__)
+
+compression_ratio = Histogram(
+    "farss_server_compression_ratio",
+    "Ratio of compressed to uncompressed size, each time a feed body is compressed",
+    ["encoding"],
+    buckets=[0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1],
+)
+compression_bytes_saved = Counter(
+    "farss_server_compression_bytes_saved_count",
+    "Number of bytes saved by sending compressed feed bodies rather than uncompressed ones",
+    ["encoding"],
+)
+
+# Supported content encodings, in order of preference when the client accepts several equally
+SUPPORTED_ENCODINGS = ["br", "gzip"]
+
+
+def negotiate_encoding(accept_encodings: Accept) -> Optional[str]:
+    return accept_encodings.best_match(SUPPORTED_ENCODINGS)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        compressed = brotli.compress(body, mode=brotli.MODE_TEXT)
+    elif encoding == "gzip":
+        compressed = gzip.compress(body)
+    else:
+        raise ValueError(f"Unsupported content encoding: {encoding}")
+    if body:
+        compression_ratio.labels(encoding=encoding).observe(len(compressed) / len(body))
+    return compressed
+
+
+def record_bytes_saved(body: bytes, compressed: bytes, encoding: str) -> None:
+    compression_bytes_saved.labels(encoding=encoding).inc(max(len(body) - len(compressed), 0))
@@ -3,16 +3,20 @@ import datetime
 import logging
 from asyncio import Semaphore
 from contextlib import asynccontextmanager
-from typing import Iterator
+from typing import Iterator, Optional
 
+import aiohttp
 from prometheus_client import Gauge, Counter
 
 from fa_rss.database.database import Database
 from fa_rss.faexport.client import FAExportClient
-from fa_rss.faexport.errors import SubmissionNotFound, FACloudflareError, FAExportHostUnavailable, FAExportUnknownError, \
-    FAUserDisabled
+from fa_rss.faexport.errors import SubmissionNotFound, FACloudflareError, FAExportHostUnavailable, FAExportError, \
+    FAUserDisabled, UserNotFound
 from fa_rss.faexport.models import Submission
-from fa_rss.database.models import User
+from fa_rss.faexport.priority import ApiPriority, api_priority
+from fa_rss.database.models import User, UserInitJob, SubmissionGap
+from fa_rss.partition_manager import PartitionManager
+from fa_rss.poll_scheduler import PollScheduler
 from fa_rss.settings import Settings
 
 
@@ -36,6 +40,45 @@ watcher_submissions_deleted = Counter(
     "farss_datafetcher_deleted_submissions_count",
     "Count of how many submissions were deleted before the data fetcher could fetch them"
 )
+watcher_ingest_lag = Gauge(
+    "farss_datafetcher_ingest_lag_seconds",
+    "Time between the latest ingested submission being posted to FA, and the data watcher saving it"
+)
+watcher_lag = Gauge(
+    "farss_datafetcher_lag_submission_count",
+    "Number of submission IDs between the data watcher's high water mark and the latest ID on FA"
+)
+watcher_in_flight = Gauge(
+    "farss_datafetcher_in_flight_submission_count",
+    "Number of submissions currently being fetched by data watcher workers"
+)
+watcher_worker_processed = Counter(
+    "farss_datafetcher_worker_processed_submissions_count",
+    "Count of how many submission IDs have been processed by each data watcher worker",
+    ["worker"],
+)
+
+watcher_gaps_recorded = Counter(
+    "farss_datafetcher_recorded_gaps_count",
+    "Count of how many submission IDs the data watcher could not fetch, and recorded in the gap ledger to retry later"
+)
+watcher_outstanding_gaps = Gauge(
+    "farss_datafetcher_outstanding_gaps",
+    "Number of submission IDs in the gap ledger which are still due to be retried"
+)
+watcher_failed_gaps = Gauge(
+    "farss_datafetcher_failed_gaps",
+    "Number of submission IDs in the gap ledger which could not be fetched after the maximum number of retries"
+)
+user_init_jobs_processed = Counter(
+    "farss_datafetcher_user_init_jobs_count",
+    "Count of user initialisation jobs processed from the job queue, by outcome",
+    ["outcome"],
+)
+user_init_jobs_queued = Gauge(
+    "farss_datafetcher_user_init_jobs_queued",
+    "Number of user initialisation jobs in the job queue, as of the last time a worker found it empty or claimed a job"
+)
 
 
 logger = logging.getLogger(__name__)
@@ -43,50 +86,83 @@ logger = logging.getLogger(__name__)
 
 class DataFetcher:
     CLOUDFLARE_BACKOFF = 20
-    RETRY_ATTEMPTS = 10
+    RETRY_ATTEMPTS = 3
+    GAP_RETRY_BACKOFF_SECONDS = 5*60
+    GAP_MAX_ATTEMPTS = 15
+    GAP_RETRY_POLL_SECONDS = 60
     USER_INIT_TIMEOUT_SECONDS = 20*60
+    DEFAULT_INGEST_WORKERS = 4
+    DEFAULT_USER_INIT_WORKERS = 2
+    USER_INIT_PRIORITY_FEED_REQUEST = 10
+    USER_INIT_MAX_ATTEMPTS = 5
+    USER_INIT_RETRY_BACKOFF_SECONDS = 60
+    USER_INIT_POLL_SECONDS = 2
+    # Fetched submissions are saved in chunks of this size, so that a retried initialisation resumes where it stopped
+    USER_INIT_SAVE_CHUNK = 50
 
-    def __init__(self, database: Database, api: FAExportClient) -> None:
+    def __init__(
+            self,
+            database: Database,
+            api: FAExportClient,
+            *,
+            ingest_workers: int = DEFAULT_INGEST_WORKERS,
+            partition_manager: Optional[PartitionManager] = None,
+            poll_scheduler: Optional[PollScheduler] = None,
+    ) -> None:
         self.running = False
         self.db = database
         self.settings = Settings(database)
         self.api = api
+        self.ingest_workers = ingest_workers
+        self.partition_manager = partition_manager
+        self.poll_scheduler = poll_scheduler or PollScheduler()
         self._users_being_initialised: set[str] = set()
 
-    async def fetch_submission(self, submission_id: int) -> Submission:
+    async def fetch_submission(self, submission_id: int, *, save: bool = True) -> Submission:
         submission = await self.db.get_submission(submission_id)
         if submission:
             return submission
         submission = await self.api.get_submission(submission_id)
-        await self.db.save_submission(submission)
+        if save:
+            await self.db.save_submission(submission)
         return submission
 
-    async def fetch_submission_eventually(self, submission_id: int) -> Submission:
-        attempt_count = 0
-        while self.running:
-            attempt_count += 1
+    async def fetch_submission_or_gap(self, submission_id: int) -> Submission | SubmissionGap:
+        """
+        Tries a few times to fetch a submission, returning a gap to retry later if it could not be fetched
+        """
+        last_error: Optional[Exception] = None
+        for attempt_count in range(1, self.RETRY_ATTEMPTS + 1):
+            if attempt_count > 1:
+                await asyncio.sleep(self.CLOUDFLARE_BACKOFF)
             try:
-                return await self.fetch_submission(submission_id)
-            except FACloudflareError:
+                return await self.fetch_submission(submission_id, save=False)
+            except FACloudflareError as e:
                 logger.warning("Could not fetch submission as FurAffinity is under cloudflare protection, waiting to retry")
-                await asyncio.sleep(self.CLOUDFLARE_BACKOFF)
-            except FAExportHostUnavailable:
+                last_error = e
+            except FAExportHostUnavailable as e:
                 logger.warning("Could not reach FAExport API host server, waiting to retry")
-                await asyncio.sleep(self.CLOUDFLARE_BACKOFF)
-            except FAExportUnknownError as e:
-                if attempt_count >= self.RETRY_ATTEMPTS:
-                    raise e
-                logger.warning("Unknown error from FAExport, attempt %s/%s waiting to retry ", attempt_count, self.RETRY_ATTEMPTS, exc_info=e)
-                await asyncio.sleep(self.CLOUDFLARE_BACKOFF)
-        raise ValueError("Could not fetch submission before Data Fetcher shut down")
+                last_error = e
+            except (SubmissionNotFound, FAUserDisabled):
+                raise
+            except (FAExportError, aiohttp.ClientError, TimeoutError) as e:
+                logger.warning("Error fetching submission, attempt %s/%s", attempt_count, self.RETRY_ATTEMPTS, exc_info=e)
+                last_error = e
+        logger.warning("Could not fetch submission %s, recording gap to retry later", submission_id)
+        return SubmissionGap(
+            submission_id,
+            self.RETRY_ATTEMPTS,
+            datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.GAP_RETRY_BACKOFF_SECONDS),
+            str(last_error),
+        )
 
-    async def fetch_submission_if_exists(self, submission_id: int) -> None:
+    async def fetch_new_submission_if_exists(self, submission_id: int) -> Optional[Submission]:
         try:
-            await self.fetch_submission(submission_id)
+            return await self.api.get_submission(submission_id)
         except SubmissionNotFound:
-            pass
+            return None
         except FAUserDisabled:
-            pass
+            return None
 
     @asynccontextmanager
     async def _track_user_init_task(self, username: str) -> Iterator[None]:
@@ -112,17 +188,36 @@ class DataFetcher:
                 self.api.get_scraps_ids(username, sfw_mode=True),
             )
             submission_ids = list(set(sum(gallery_id_lists, start=[])))
+            # Only fetch submissions which are not already in the database
+            known_submissions = await self.db.get_submissions(submission_ids)
             # Maximum of 5 submissions requested at a time
             sem = Semaphore(5)
+            unsaved: list[Submission] = []
+            save_lock = asyncio.Lock()
+
+            async def _save_unsaved() -> None:
+                nonlocal unsaved
+                async with save_lock:
+                    batch, unsaved = unsaved, []
+                    if batch:
+                        await self.db.save_submissions(batch)
 
             async def _fetch_wrapper(sub_id: int) -> None:
                 async with sem:
-                    return await self.fetch_submission_if_exists(sub_id)
+                    submission = await self.fetch_new_submission_if_exists(sub_id)
+                if submission is None:
+                    return
+                unsaved.append(submission)
+                if len(unsaved) >= self.USER_INIT_SAVE_CHUNK:
+                    await _save_unsaved()
             fetch_tasks = [
                 _fetch_wrapper(sub_id)
                 for sub_id in submission_ids
+                if sub_id not in known_submissions
             ]
             await asyncio.gather(*fetch_tasks)
+            # Save the remainder before marking the user as initialised
+            await _save_unsaved()
             user = User(
                 username,
                 datetime.datetime.now(datetime.timezone.utc)
@@ -130,13 +225,61 @@ class DataFetcher:
             await self.db.save_user(user)
             return user
 
+    async def run_user_init_workers(self, worker_count: int = DEFAULT_USER_INIT_WORKERS) -> None:
+        self.running = True
+        # Someone is waiting on their first feed, so this takes priority over ingesting new submissions
+        api_priority.set(ApiPriority.USER_INIT)
+        await asyncio.gather(*[self._user_init_worker() for _ in range(worker_count)])
+
+    async def _user_init_worker(self) -> None:
+        # Give the job a little longer than the initialisation timeout, so that it is not picked up by another worker
+        visibility_timeout = self.USER_INIT_TIMEOUT_SECONDS + 60
+        while self.running:
+            job = await self.db.claim_user_init_job(visibility_timeout)
+            if job is None:
+                user_init_jobs_queued.set(await self.db.count_user_init_jobs())
+                await asyncio.sleep(self.USER_INIT_POLL_SECONDS)
+                continue
+            await self._run_user_init_job(job)
+
+    async def _run_user_init_job(self, job: UserInitJob) -> None:
+        if await self.db.get_user(job.username) is not None:
+            logger.info("User already initialised, dropping initialisation job: %s", job.username)
+            user_init_jobs_processed.labels(outcome="already_initialised").inc()
+            await self.db.complete_user_init_job(job)
+            return
+        try:
+            await self.initialise_user_data(job.username)
+        except (UserNotFound, FAUserDisabled):
+            logger.info("User no longer exists, dropping initialisation job: %s", job.username)
+            user_init_jobs_processed.labels(outcome="user_missing").inc()
+            await self.db.complete_user_init_job(job)
+        except Exception as e:
+            if job.attempts >= self.USER_INIT_MAX_ATTEMPTS:
+                logger.error("User initialisation failed %s times, giving up: %s", job.attempts, job.username, exc_info=e)
+                user_init_jobs_processed.labels(outcome="abandoned").inc()
+                await self.db.complete_user_init_job(job)
+                return
+            logger.warning("User initialisation failed, will retry: %s", job.username, exc_info=e)
+            user_init_jobs_processed.labels(outcome="retry").inc()
+            retry_delay = self.USER_INIT_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+            await self.db.retry_user_init_job(job, str(e), retry_delay)
+        else:
+            user_init_jobs_processed.labels(outcome="success").inc()
+            await self.db.complete_user_init_job(job)
+
     async def run_data_watcher(self) -> None:
         watcher_startup_time.set_to_current_time()
         self.running = True
+        api_priority.set(ApiPriority.INGEST)
         latest_submission_id = await self.settings.get_latest_submission_id()
         while self.running:
-            await asyncio.sleep(10)
+            await self.poll_scheduler.wait()
             new_latest = await self.fetch_latest_submission_id()
+            self.poll_scheduler.record_poll(new_latest)
+            # Make sure there are partitions ready to save the new submissions into
+            if self.partition_manager is not None:
+                await self.partition_manager.ensure_partitions(new_latest)
             # Set initial high water mark if unset
             if latest_submission_id is None:
                 logger.info("Setting initial submission ID: %s", new_latest)
@@ -146,29 +289,115 @@ class DataFetcher:
             # Skip if already seen newer submissions
             if new_latest <= latest_submission_id:
                 continue
-            # Make list of new IDs to check
+            # Fetch the new IDs concurrently, advancing the high water mark as they complete
             new_ids = range(latest_submission_id + 1, new_latest + 1)
-            for new_id in new_ids:
-                # Fetch and save new submission
-                try:
-                    new_submission = await self.fetch_submission_eventually(new_id)
-                except (SubmissionNotFound, FAUserDisabled):
-                    watcher_submissions_deleted.inc()
-                    continue
-                # Update metrics
-                logger.info("Fetched new submission: %s", new_submission.submission_id)
-                watcher_latest_id.set(new_submission.submission_id)
-                watcher_latest_posted_at.set(new_submission.posted_at.timestamp())
-                watcher_submissions_saved.inc()
-                latest_submission_id = new_id
-                # Update high water mark
-                await self.settings.update_latest_submission_id(latest_submission_id)
-                # Shutdown if asked
+            watcher_lag.set(len(new_ids))
+            latest_submission_id = await self._ingest_new_ids(new_ids, latest_submission_id)
+            # Shutdown if asked
+            if not self.running:
+                break
+
+    async def _ingest_new_ids(self, new_ids: range, latest_submission_id: int) -> int:
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for new_id in new_ids:
+            queue.put_nowait(new_id)
+        # Submission IDs which have been processed but are not yet contiguous with the high water mark
+        completed: dict[int, Submission | SubmissionGap | None] = {}
+        high_water_lock = asyncio.Lock()
+
+        async def _mark_complete(submission_id: int, result: Submission | SubmissionGap | None) -> None:
+            nonlocal latest_submission_id
+            completed[submission_id] = result
+            async with high_water_lock:
+                new_high_water_mark = latest_submission_id
+                batch: list[Submission] = []
+                gaps: list[SubmissionGap] = []
+                while new_high_water_mark + 1 in completed:
+                    new_high_water_mark += 1
+                    done_result = completed.pop(new_high_water_mark)
+                    if isinstance(done_result, Submission):
+                        batch.append(done_result)
+                    elif isinstance(done_result, SubmissionGap):
+                        gaps.append(done_result)
+                if new_high_water_mark == latest_submission_id:
+                    return
+                # Save the contiguous batch, any gaps, and the new high water mark in one transaction
+                await self.settings.save_ingested_submissions(batch, gaps, new_high_water_mark)
+                latest_submission_id = new_high_water_mark
+                watcher_submissions_saved.inc(len(batch))
+                watcher_latest_id.set(latest_submission_id)
+                watcher_lag.set(new_ids.stop - 1 - latest_submission_id)
+                if batch:
+                    watcher_latest_posted_at.set(batch[-1].posted_at.timestamp())
+                    ingest_lag = datetime.datetime.now(datetime.timezone.utc) - batch[-1].posted_at
+                    watcher_ingest_lag.set(ingest_lag.total_seconds())
+
+        async def _worker(worker_num: int) -> None:
+            while self.running and not queue.empty():
+                new_id = queue.get_nowait()
+                with watcher_in_flight.track_inprogress():
+                    result = await self._ingest_submission(new_id)
+                watcher_worker_processed.labels(worker=str(worker_num)).inc()
+                await _mark_complete(new_id, result)
+
+        async with asyncio.TaskGroup() as task_group:
+            for worker_num in range(min(self.ingest_workers, len(new_ids))):
+                task_group.create_task(_worker(worker_num))
+        return latest_submission_id
+
+    async def _ingest_submission(self, submission_id: int) -> Submission | SubmissionGap | None:
+        # Fetch new submission, it is saved once it is part of a contiguous batch
+        try:
+            result = await self.fetch_submission_or_gap(submission_id)
+        except (SubmissionNotFound, FAUserDisabled):
+            watcher_submissions_deleted.inc()
+            return None
+        if isinstance(result, SubmissionGap):
+            watcher_gaps_recorded.inc()
+            return result
+        logger.info("Fetched new submission: %s", result.submission_id)
+        return result
+
+    async def run_gap_retrier(self) -> None:
+        """
+        Low priority retry lane, which works through the ledger of submission IDs the data watcher could not fetch
+        """
+        self.running = True
+        api_priority.set(ApiPriority.REFRESH)
+        while self.running:
+            gaps = await self.db.list_due_submission_gaps()
+            for gap in gaps:
                 if not self.running:
                     break
-            # Wait before next fetch
-            logger.info("Waiting before fetching new batch of submissions")
-            await asyncio.sleep(10)
+                await self._retry_gap(gap)
+            watcher_outstanding_gaps.set(await self.db.count_submission_gaps())
+            watcher_failed_gaps.set(await self.db.count_submission_gaps(failed=True))
+            if not gaps:
+                await asyncio.sleep(self.GAP_RETRY_POLL_SECONDS)
+
+    async def _retry_gap(self, gap: SubmissionGap) -> None:
+        try:
+            submission = await self.fetch_submission(gap.submission_id, save=False)
+        except (SubmissionNotFound, FAUserDisabled):
+            logger.info("Submission gap was deleted from FA: %s", gap.submission_id)
+            watcher_submissions_deleted.inc()
+            await self.db.resolve_submission_gap(gap, None)
+            return
+        except (FAExportError, aiohttp.ClientError, TimeoutError) as e:
+            gap.attempts += 1
+            gap.last_error = str(e)
+            retry_delay = self.GAP_RETRY_BACKOFF_SECONDS * 2 ** min(gap.attempts - self.RETRY_ATTEMPTS, 6)
+            gap.next_retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retry_delay)
+            failed = gap.attempts >= self.GAP_MAX_ATTEMPTS
+            if failed:
+                logger.error("Giving up on fetching submission gap %s after %s attempts", gap.submission_id, gap.attempts, exc_info=e)
+            else:
+                logger.warning("Retry of submission gap %s failed, will retry again", gap.submission_id, exc_info=e)
+            await self.db.update_submission_gap(gap, failed=failed)
+            return
+        logger.info("Filled submission gap: %s", gap.submission_id)
+        await self.db.resolve_submission_gap(gap, submission)
+        watcher_submissions_saved.inc()
 
     async def fetch_latest_submission_id(self) -> int:
         home_data = await self.get_home_page_eventually()
@@ -1,17 +1,89 @@
+import dataclasses
+import json
 import logging
+import time
 from contextlib import asynccontextmanager
-from typing import Optional, Generator
+from typing import Optional, Generator, Callable, AsyncIterator
 
-import psycopg
-from psycopg import AsyncConnection, AsyncCursor
+from prometheus_client import Gauge, Counter, Histogram
+from psycopg import AsyncConnection, AsyncCursor, sql
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 
 from fa_rss.faexport.models import Submission
-from fa_rss.database.models import User
+from fa_rss.database.models import User, FeedVersion, UserInitJob, SubmissionGap, SubmissionPartition, \
+    SubmissionChange
+from fa_rss.database.notifications import NotificationListener, SETTINGS_CHANGED, SUBMISSION_CHANGED, \
+    USER_INITIALISED
 
 logger = logging.getLogger(__name__)
 
+pool_wait_time = Histogram(
+    "farss_database_pool_wait_seconds",
+    "Time spent waiting to acquire a connection from the database connection pool",
+)
+pool_connections_in_use = Gauge(
+    "farss_database_pool_connections_in_use",
+    "Number of database connections currently checked out of the connection pool",
+)
+query_duration = Histogram(
+    "farss_database_query_duration_seconds",
+    "Time spent holding a database connection for each query, by query name",
+    ["query"],
+)
+pool_acquire_timeouts = Counter(
+    "farss_database_pool_acquire_timeout_count",
+    "Number of times acquiring a connection from the database connection pool timed out",
+)
+
 SFW_RATING = "General"
+# Inlined into SFW feed queries rather than passed as a parameter, so that the planner can match it against the
+# predicate of the SFW partial indexes
+SFW_CONDITION = f"rating = '{SFW_RATING}'"
+# Advisory lock key held while applying schema migrations, so that processes starting at the same time do not race
+MIGRATION_LOCK_KEY = 72_616_573
+# Indexes on the partitioned submissions table besides its primary key, by the suffix given to each partition's copy.
+# They must match the definitions in the migrations, so that a partition's own indexes are adopted when it is attached.
+SUBMISSION_PARTITION_INDEXES = [
+    ("username_gallery_id", "(username, gallery, submission_id DESC)"),
+    ("username_gallery_id_sfw", f"(username, gallery, submission_id DESC) WHERE {SFW_CONDITION}"),
+    ("id_sfw", f"(submission_id DESC) WHERE {SFW_CONDITION}"),
+]
+
+
+def recent_submissions_query(columns: str, sfw_mode: bool) -> str:
+    """
+    Builds the query for the newest submissions. SFW and non-SFW feeds use separate queries, so that each one is a
+    plain range scan of a single index.
+    """
+    return (
+        f"SELECT {columns} FROM submissions"
+        + (f" WHERE {SFW_CONDITION}" if sfw_mode else "")
+        + " ORDER BY submission_id DESC"
+        " LIMIT %(limit)s"
+    )
+
+
+def user_gallery_submissions_query(columns: str, sfw_mode: bool) -> str:
+    """
+    Builds the query for the newest submissions in a user's gallery, which is served by the
+    (username, gallery, submission_id DESC) index, or its SFW partial variant.
+    """
+    return (
+        f"SELECT {columns} FROM submissions"
+        " WHERE username = %(username)s AND gallery = %(gallery)s"
+        + (f" AND {SFW_CONDITION}" if sfw_mode else "")
+        + " ORDER BY submission_id DESC"
+        " LIMIT %(limit)s"
+    )
+
+
+def feed_version_query(feed_query: str) -> str:
+    return (
+        "SELECT max(submission_id) AS latest_id, min(submission_id) AS oldest_id, count(*) AS sub_count,"
+        "  max(posted_at) AS last_posted_at, max(updated_at) AS last_updated_at"
+        f" FROM ({feed_query}) AS feed"
+    )
 
 
 class Database:
@@ -21,17 +93,82 @@ class Database:
         user = db_config.get("user", "postgres")
         password = db_config["password"]
         self.conn_string = f"host={host} dbname={dbname} user={user} password={password}"
+        pool_config = db_config.get("pool", {})
+        self.acquire_timeout = pool_config.get("acquire_timeout", 10)
+        self.pool = AsyncConnectionPool(
+            self.conn_string,
+            min_size=pool_config.get("min_size", 2),
+            max_size=pool_config.get("max_size", 10),
+            timeout=self.acquire_timeout,
+            max_idle=pool_config.get("max_idle", 10 * 60),
+            max_lifetime=pool_config.get("max_lifetime", 60 * 60),
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row},
+            name="fa-rss",
+            open=False,
+        )
+        # Change notifications from every process, only started by processes which keep caches
+        self.notifications = NotificationListener(self.conn_string)
+
+    def add_submission_listener(self, listener: Callable[[SubmissionChange], None]) -> None:
+        """
+        Calls the listener whenever any process saves or deletes a submission, once the change is committed
+        """
+        self.notifications.add_handler(
+            SUBMISSION_CHANGED,
+            lambda payload: listener(SubmissionChange(**json.loads(payload))),
+        )
+
+    def add_user_initialised_listener(self, listener: Callable[[str], None]) -> None:
+        self.notifications.add_handler(USER_INITIALISED, listener)
+
+    @staticmethod
+    async def _notify_submissions_changed(
+            cur: AsyncCursor,
+            submissions: list[Submission],
+            previous: Optional[dict[int, tuple[str, str]]] = None,
+    ) -> None:
+        # Notifications are only delivered when the transaction commits
+        previous = previous or {}
+        await cur.executemany(
+            "SELECT pg_notify(%s, %s)",
+            [
+                (
+                    SUBMISSION_CHANGED,
+                    json.dumps(dataclasses.asdict(
+                        SubmissionChange.from_submission(submission, previous.get(submission.submission_id))
+                    )),
+                )
+                for submission in submissions
+            ]
+        )
+
+    async def open(self) -> None:
+        logger.info("Opening database connection pool")
+        await self.pool.open()
+
+    async def close(self) -> None:
+        logger.info("Closing database connection pool")
+        await self.pool.close()
 
     @asynccontextmanager
-    async def cursor(self) -> Generator[tuple[AsyncConnection, AsyncCursor], None, None]:
-        async with await psycopg.AsyncConnection.connect(self.conn_string, row_factory=dict_row) as conn:
-            async with conn.cursor() as cur:
-                yield conn, cur
+    async def cursor(self, query_name: str) -> Generator[tuple[AsyncConnection, AsyncCursor], None, None]:
+        wait_start = time.monotonic()
+        try:
+            async with self.pool.connection(timeout=self.acquire_timeout) as conn:
+                pool_wait_time.observe(time.monotonic() - wait_start)
+                with pool_connections_in_use.track_inprogress(), query_duration.labels(query=query_name).time():
+                    async with conn.cursor() as cur:
+                        yield conn, cur
+        except PoolTimeout:
+            pool_acquire_timeouts.inc()
+            logger.warning("Timed out waiting for a database connection from the pool")
+            raise
 
     async def get_user(self, username: str) -> Optional[User]:
         # Usernames are always lowercase
         username = username.lower()
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("get_user") as (conn, cur):
             logger.info("Fetch user from DB")
             await cur.execute(
                 "SELECT username, initialised_date FROM users WHERE username = %s", (username,)
@@ -45,13 +182,20 @@ class Database:
             )
 
     async def list_recent_submissions(self, *, limit: int = 20, sfw_mode: bool = False) -> list[Submission]:
-        rating: Optional[str] = None
-        if sfw_mode is True:
-            rating = SFW_RATING
-        async with self.cursor() as (conn, cur):
+        return [
+            submission async for submission in self.iter_recent_submissions(limit=limit, sfw_mode=sfw_mode)
+        ]
+
+    async def iter_recent_submissions(self, *, limit: int = 20, sfw_mode: bool = False) -> AsyncIterator[Submission]:
+        async with self.cursor("iter_recent_submissions") as (conn, cur):
             logger.info("List recent submissions in DB")
-            return [
-                Submission(
+            async for row in cur.stream(
+                recent_submissions_query("*", sfw_mode),
+                {
+                    "limit": limit,
+                }
+            ):
+                yield Submission(
                     row["submission_id"],
                     row["username"],
                     row["gallery"],
@@ -62,27 +206,26 @@ class Database:
                     row["posted_at"],
                     row["rating"],
                     row["keywords"],
-                ) async for row in cur.stream(
-                    "SELECT * FROM submissions"
-                    " WHERE (%(rating)s::text IS NULL OR rating = %(rating)s::text)"
-                    " ORDER BY submission_id DESC"
-                    " LIMIT %(limit)s",
-                    {
-                        "rating": rating,
-                        "limit": limit,
-                    }
                 )
-            ]
 
     async def list_submissions_by_user_gallery(self, username: str, gallery: str, *, limit: int = 20, sfw_mode: bool = False) -> list[Submission]:
+        return [
+            submission async for submission in self.iter_submissions_by_user_gallery(username, gallery, limit=limit, sfw_mode=sfw_mode)
+        ]
+
+    async def iter_submissions_by_user_gallery(self, username: str, gallery: str, *, limit: int = 20, sfw_mode: bool = False) -> AsyncIterator[Submission]:
         username = username.lower()
-        rating: Optional[str] = None
-        if sfw_mode:
-            rating = SFW_RATING
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("iter_submissions_by_user_gallery") as (conn, cur):
             logger.info("List submissions in gallery from DB")
-            return [
-                Submission(
+            async for row in cur.stream(
+                user_gallery_submissions_query("*", sfw_mode),
+                {
+                    "username": username,
+                    "gallery": gallery,
+                    "limit": limit,
+                },
+            ):
+                yield Submission(
                     row["submission_id"],
                     row["username"],
                     row["gallery"],
@@ -93,22 +236,41 @@ class Database:
                     row["posted_at"],
                     row["rating"],
                     row["keywords"],
-                ) async for row in cur.stream(
-                    "SELECT * FROM submissions"
-                    " WHERE username = %(username)s AND gallery = %(gallery)s AND (%(rating)s::text IS NULL OR rating = %(rating)s::text)"
-                    " ORDER BY submission_id DESC"
-                    " LIMIT %(limit)s",
-                    {
-                        "username": username,
-                        "gallery": gallery,
-                        "limit": limit,
-                        "rating": rating,
-                    },
                 )
-            ]
+
+    async def get_recent_feed_version(self, *, limit: int = 20, sfw_mode: bool = False) -> FeedVersion:
+        async with self.cursor("get_recent_feed_version") as (conn, cur):
+            logger.info("Fetch recent submissions feed version from DB")
+            await cur.execute(
+                feed_version_query(recent_submissions_query("submission_id, posted_at, updated_at", sfw_mode)),
+                {
+                    "limit": limit,
+                }
+            )
+            row = await cur.fetchone()
+            return FeedVersion(
+                row["latest_id"], row["oldest_id"], row["sub_count"], row["last_posted_at"], row["last_updated_at"]
+            )
+
+    async def get_user_gallery_feed_version(self, username: str, gallery: str, *, limit: int = 20, sfw_mode: bool = False) -> FeedVersion:
+        username = username.lower()
+        async with self.cursor("get_user_gallery_feed_version") as (conn, cur):
+            logger.info("Fetch gallery feed version from DB")
+            await cur.execute(
+                feed_version_query(user_gallery_submissions_query("submission_id, posted_at, updated_at", sfw_mode)),
+                {
+                    "username": username,
+                    "gallery": gallery,
+                    "limit": limit,
+                }
+            )
+            row = await cur.fetchone()
+            return FeedVersion(
+                row["latest_id"], row["oldest_id"], row["sub_count"], row["last_posted_at"], row["last_updated_at"]
+            )
 
     async def get_submission(self, submission_id: int) -> Optional[Submission]:
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("get_submission") as (conn, cur):
             logger.info("Fetch submission from DB")
             await cur.execute(
                 "SELECT * FROM submissions WHERE submission_id = %s", (submission_id,)
@@ -129,10 +291,58 @@ class Database:
                 row["keywords"],
             )
 
+    async def get_submissions(self, submission_ids: list[int]) -> dict[int, Submission]:
+        if not submission_ids:
+            return {}
+        async with self.cursor("get_submissions") as (conn, cur):
+            logger.info("Fetch batch of %s submissions from DB", len(submission_ids))
+            return {
+                row["submission_id"]: Submission(
+                    row["submission_id"],
+                    row["username"],
+                    row["gallery"],
+                    row["title"],
+                    row["description"],
+                    row["download_url"],
+                    row["thumbnail_url"],
+                    row["posted_at"],
+                    row["rating"],
+                    row["keywords"],
+                ) async for row in cur.stream(
+                    "SELECT * FROM submissions WHERE submission_id = ANY(%s)", (submission_ids,)
+                )
+            }
+
     async def save_submission(self, submission: Submission) -> None:
-        async with self.cursor() as (conn, cur):
-            logger.info("Save submission to DB")
-            await cur.execute(
+        await self.save_submissions([submission])
+
+    async def save_submissions(
+            self,
+            submissions: list[Submission],
+            *,
+            new_gaps: Optional[list[SubmissionGap]] = None,
+            resolved_gaps: Optional[list[SubmissionGap]] = None,
+            setting_updates: Optional[dict[str, str]] = None,
+    ) -> None:
+        """
+        Saves a batch of submissions, along with any changes to the submission gap ledger and settings, in a single
+        transaction
+        """
+        # Rows are always locked in ID order, so that concurrent batches saving the same submissions, such as a user's
+        # initialisation and ingestion of their new submissions, cannot deadlock
+        submissions = sorted(submissions, key=lambda submission: submission.submission_id)
+        async with self.cursor("save_submissions") as (conn, cur):
+            logger.info("Save batch of %s submissions to DB", len(submissions))
+            # Where submissions already stored were, so that feeds they move out of are told about the change too
+            previous: dict[int, tuple[str, str]] = {}
+            if submissions:
+                await cur.execute(
+                    "SELECT submission_id, gallery, rating FROM submissions WHERE submission_id = ANY(%s)"
+                    " ORDER BY submission_id FOR UPDATE",
+                    ([submission.submission_id for submission in submissions],)
+                )
+                previous = {row["submission_id"]: (row["gallery"], row["rating"]) for row in await cur.fetchall()}
+            await cur.executemany(
                 "INSERT INTO submissions ("
                 "  submission_id, username, gallery, title, description, download_url, thumbnail_url, posted_at, "
                 "  rating, keywords"
@@ -145,33 +355,503 @@ class Database:
                 " DO UPDATE SET "
                 "  username = %(username)s, gallery = %(gallery)s, title = %(title)s, description = %(description)s, "
                 "  download_url = %(download_url)s, thumbnail_url = %(thumbnail_url)s, posted_at = %(posted_at)s, "
-                "  rating = %(rating)s, keywords = %(keywords)s",
+                "  rating = %(rating)s, keywords = %(keywords)s, updated_at = now()"
+                # Saving a submission unchanged, as ingestion retries and refreshes can, leaves its feeds' versions alone
+                " WHERE (submissions.username, submissions.gallery, submissions.title, submissions.description,"
+                "  submissions.download_url, submissions.thumbnail_url, submissions.posted_at, submissions.rating,"
+                "  submissions.keywords) IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.gallery, EXCLUDED.title,"
+                "  EXCLUDED.description, EXCLUDED.download_url, EXCLUDED.thumbnail_url, EXCLUDED.posted_at,"
+                "  EXCLUDED.rating, EXCLUDED.keywords)",
+                [
+                    {
+                        'submission_id': submission.submission_id,
+                        'username': submission.username,
+                        'gallery': submission.gallery,
+                        'title': submission.title,
+                        'description': submission.description,
+                        'download_url': submission.download_url,
+                        'thumbnail_url': submission.thumbnail_url,
+                        'posted_at': submission.posted_at,
+                        'rating': submission.rating,
+                        'keywords': submission.keywords,
+                    }
+                    for submission in submissions
+                ]
+            )
+            if new_gaps:
+                await cur.executemany(
+                    "INSERT INTO submission_gaps (submission_id, attempts, next_retry_at, last_error)"
+                    " VALUES (%s, %s, %s, %s) ON CONFLICT (submission_id) DO NOTHING",
+                    [
+                        (gap.submission_id, gap.attempts, gap.next_retry_at, gap.last_error)
+                        for gap in new_gaps
+                    ]
+                )
+            if resolved_gaps:
+                await cur.execute(
+                    "DELETE FROM submission_gaps WHERE submission_id = ANY(%s)",
+                    ([gap.submission_id for gap in resolved_gaps],)
+                )
+            if setting_updates:
+                await cur.executemany(
+                    "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = %s",
+                    [
+                        (setting_key, setting_value, setting_value)
+                        for setting_key, setting_value in setting_updates.items()
+                    ]
+                )
+                for setting_key, setting_value in setting_updates.items():
+                    await self._notify_setting_changed(cur, setting_key, setting_value)
+            if submissions:
+                await self._notify_submissions_changed(cur, submissions, previous)
+            await conn.commit()
+
+    async def list_due_submission_gaps(self, *, limit: int = 20) -> list[SubmissionGap]:
+        async with self.cursor("list_due_submission_gaps") as (conn, cur):
+            logger.info("List submission gaps due for retry from DB")
+            return [
+                SubmissionGap(
+                    row["submission_id"],
+                    row["attempts"],
+                    row["next_retry_at"],
+                    row["last_error"],
+                ) async for row in cur.stream(
+                    "SELECT submission_id, attempts, next_retry_at, last_error FROM submission_gaps"
+                    " WHERE NOT failed AND next_retry_at <= now()"
+                    " ORDER BY next_retry_at"
+                    " LIMIT %s",
+                    (limit,)
+                )
+            ]
+
+    async def resolve_submission_gap(self, gap: SubmissionGap, submission: Optional[Submission]) -> None:
+        """
+        Removes a gap from the ledger, saving the submission in the same transaction if it still exists
+        """
+        if submission is not None:
+            await self.save_submissions([submission], resolved_gaps=[gap])
+            return
+        async with self.cursor("resolve_submission_gap") as (conn, cur):
+            logger.info("Remove resolved submission gap from DB")
+            await cur.execute("DELETE FROM submission_gaps WHERE submission_id = %s", (gap.submission_id,))
+            await conn.commit()
+
+    async def update_submission_gap(self, gap: SubmissionGap, *, failed: bool = False) -> None:
+        async with self.cursor("update_submission_gap") as (conn, cur):
+            logger.info("Update submission gap in DB")
+            await cur.execute(
+                "UPDATE submission_gaps"
+                " SET attempts = %(attempts)s, next_retry_at = %(next_retry_at)s, last_error = %(last_error)s,"
+                "  failed = %(failed)s"
+                " WHERE submission_id = %(submission_id)s",
                 {
-                    'submission_id': submission.submission_id,
-                    'username': submission.username,
-                    'gallery': submission.gallery,
-                    'title': submission.title,
-                    'description': submission.description,
-                    'download_url': submission.download_url,
-                    'thumbnail_url': submission.thumbnail_url,
-                    'posted_at': submission.posted_at,
-                    'rating': submission.rating,
-                    'keywords': submission.keywords,
+                    "submission_id": gap.submission_id,
+                    "attempts": gap.attempts,
+                    "next_retry_at": gap.next_retry_at,
+                    "last_error": gap.last_error,
+                    "failed": failed,
                 }
             )
             await conn.commit()
 
+    async def count_submission_gaps(self, *, failed: bool = False) -> int:
+        async with self.cursor("count_submission_gaps") as (conn, cur):
+            await cur.execute("SELECT count(*) AS gap_count FROM submission_gaps WHERE failed = %s", (failed,))
+            row = await cur.fetchone()
+            return row["gap_count"]
+
     async def save_user(self, user: User) -> None:
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("save_user") as (conn, cur):
             logger.info("Save user to DB")
             await cur.execute(
                 "INSERT INTO users (username, initialised_date) VALUES (%s,%s) ON CONFLICT (username) DO NOTHING",
                 (user.username, user.date_initialised)
             )
+            await cur.execute("SELECT pg_notify(%s, %s)", (USER_INITIALISED, user.username))
+            await conn.commit()
+
+    async def enqueue_user_init_job(self, username: str, priority: int = 0) -> None:
+        username = username.lower()
+        async with self.cursor("enqueue_user_init_job") as (conn, cur):
+            logger.info("Enqueue user initialisation job in DB")
+            await cur.execute(
+                "INSERT INTO user_init_jobs (username, priority) VALUES (%(username)s, %(priority)s)"
+                " ON CONFLICT (username) DO UPDATE SET priority = GREATEST(user_init_jobs.priority, %(priority)s)",
+                {
+                    "username": username,
+                    "priority": priority,
+                }
+            )
             await conn.commit()
 
+    async def claim_user_init_job(self, visibility_timeout: float) -> Optional[UserInitJob]:
+        """
+        Claims the highest priority job which is ready to run, hiding it from other workers until the visibility timeout
+        passes. If the worker dies without completing or failing the job, another worker will then pick it up.
+        """
+        async with self.cursor("claim_user_init_job") as (conn, cur):
+            await cur.execute(
+                "UPDATE user_init_jobs"
+                " SET locked_until = now() + %(timeout)s * interval '1 second', attempts = attempts + 1"
+                " WHERE username = ("
+                "  SELECT username FROM user_init_jobs"
+                "  WHERE run_after <= now() AND (locked_until IS NULL OR locked_until < now())"
+                "  ORDER BY priority DESC, run_after"
+                "  LIMIT 1"
+                "  FOR UPDATE SKIP LOCKED"
+                " )"
+                " RETURNING username, priority, attempts",
+                {
+                    "timeout": visibility_timeout,
+                }
+            )
+            row = await cur.fetchone()
+            await conn.commit()
+            if row is None:
+                return None
+            logger.info("Claimed user initialisation job from DB")
+            return UserInitJob(
+                row["username"],
+                row["priority"],
+                row["attempts"],
+            )
+
+    async def complete_user_init_job(self, job: UserInitJob) -> None:
+        async with self.cursor("complete_user_init_job") as (conn, cur):
+            logger.info("Remove completed user initialisation job from DB")
+            await cur.execute("DELETE FROM user_init_jobs WHERE username = %s", (job.username,))
+            await conn.commit()
+
+    async def retry_user_init_job(self, job: UserInitJob, error: str, retry_delay: float) -> None:
+        async with self.cursor("retry_user_init_job") as (conn, cur):
+            logger.info("Schedule retry of user initialisation job in DB")
+            await cur.execute(
+                "UPDATE user_init_jobs"
+                " SET locked_until = NULL, run_after = now() + %(delay)s * interval '1 second', last_error = %(error)s"
+                " WHERE username = %(username)s",
+                {
+                    "username": job.username,
+                    "delay": retry_delay,
+                    "error": error,
+                }
+            )
+            await conn.commit()
+
+    async def count_user_init_jobs(self) -> int:
+        async with self.cursor("count_user_init_jobs") as (conn, cur):
+            await cur.execute("SELECT count(*) AS job_count FROM user_init_jobs")
+            row = await cur.fetchone()
+            return row["job_count"]
+
+    async def delete_submission(self, submission: Submission) -> None:
+        async with self.cursor("delete_submission") as (conn, cur):
+            logger.info("Delete submission from DB")
+            await cur.execute("DELETE FROM submissions WHERE submission_id = %s", (submission.submission_id,))
+            await self._notify_submissions_changed(cur, [submission])
+            await conn.commit()
+
+    async def record_feed_requests(self, request_counts: dict[str, int]) -> None:
+        async with self.cursor("record_feed_requests") as (conn, cur):
+            logger.info("Record feed requests for %s users in DB", len(request_counts))
+            await cur.executemany(
+                "UPDATE users SET requests_since_refresh = requests_since_refresh + %s, last_requested = now()"
+                " WHERE username = %s",
+                [
+                    (count, username)
+                    for username, count in request_counts.items()
+                ]
+            )
+            await conn.commit()
+
+    async def get_user_to_refresh(self, min_refresh_interval: float) -> Optional[User]:
+        """
+        Picks the requested user whose gallery is most in need of a refresh, weighing how often their feeds have been
+        requested against how long it has been since they were last refreshed.
+        """
+        async with self.cursor("get_user_to_refresh") as (conn, cur):
+            logger.info("Fetch user to refresh from DB")
+            await cur.execute(
+                "SELECT username, initialised_date, last_refreshed, refresh_failures FROM users"
+                " WHERE requests_since_refresh > 0"
+                "  AND coalesce(last_refreshed, initialised_date) < now() - %(interval)s * interval '1 second'"
+                "  AND (next_refresh_after IS NULL OR next_refresh_after < now())"
+                " ORDER BY requests_since_refresh"
+                "  * extract(epoch FROM now() - coalesce(last_refreshed, initialised_date)) DESC"
+                " LIMIT 1",
+                {
+                    "interval": min_refresh_interval,
+                }
+            )
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            return User(
+                row["username"],
+                row["initialised_date"],
+                row["last_refreshed"],
+                row["refresh_failures"],
+            )
+
+    async def mark_user_refreshed(self, user: User) -> None:
+        async with self.cursor("mark_user_refreshed") as (conn, cur):
+            logger.info("Mark user as refreshed in DB")
+            await cur.execute(
+                "UPDATE users SET last_refreshed = now(), requests_since_refresh = 0, refresh_failures = 0,"
+                " next_refresh_after = NULL WHERE username = %s",
+                (user.username,)
+            )
+            await conn.commit()
+
+    async def retry_user_refresh(self, user: User, retry_delay: float) -> None:
+        async with self.cursor("retry_user_refresh") as (conn, cur):
+            logger.info("Back off user refresh in DB")
+            await cur.execute(
+                "UPDATE users SET refresh_failures = refresh_failures + 1,"
+                " next_refresh_after = now() + %(delay)s * interval '1 second'"
+                " WHERE username = %(username)s",
+                {
+                    "username": user.username,
+                    "delay": retry_delay,
+                }
+            )
+            await conn.commit()
+
+    async def take_api_budget_token(self, name: str, *, rate: float, capacity: float, reserve: float) -> Optional[float]:
+        """
+        Takes a token from a shared API budget, if doing so leaves at least the reserve for higher priority requests.
+        Returns None if a token was taken, otherwise roughly how many seconds until one could be.
+        """
+        async with self.cursor("take_api_budget_token") as (conn, cur):
+            # Refilling the bucket also locks its row, so concurrent takers queue up here
+            await cur.execute(
+                "UPDATE api_budget"
+                " SET tokens = least("
+                "   %(capacity)s, tokens + extract(epoch FROM clock_timestamp() - updated_at)::float * %(rate)s"
+                "  ),"
+                "  updated_at = clock_timestamp()"
+                " WHERE name = %(name)s"
+                " RETURNING tokens",
+                {
+                    "name": name,
+                    "rate": rate,
+                    "capacity": capacity,
+                }
+            )
+            row = await cur.fetchone()
+            if row is None:
+                raise ValueError(f"No API budget named {name} in the database")
+            tokens = row["tokens"]
+            if tokens < 1 + reserve:
+                await conn.commit()
+                return (1 + reserve - tokens) / rate
+            await cur.execute("UPDATE api_budget SET tokens = tokens - 1 WHERE name = %s", (name,))
+            await conn.commit()
+            return None
+
+    async def list_submission_partitions(self) -> list[SubmissionPartition]:
+        async with self.cursor("list_submission_partitions") as (conn, cur):
+            logger.info("List submission partitions from DB")
+            await cur.execute(
+                "SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound_expr"
+                " FROM pg_inherits JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid"
+                " WHERE pg_inherits.inhparent = 'submissions'::regclass"
+            )
+            partitions = [
+                SubmissionPartition.from_partition_bound(row["name"], row["bound_expr"])
+                for row in await cur.fetchall()
+            ]
+        # Sort by lower bound, with the MINVALUE partition first
+        return sorted(partitions, key=lambda partition: (partition.lower_bound is not None, partition.lower_bound))
+
+    async def create_submission_partition(self, lower_bound: int, upper_bound: int) -> SubmissionPartition:
+        partition = SubmissionPartition(f"submissions_p{lower_bound}", lower_bound, upper_bound)
+        async with self.cursor("create_submission_partition") as (conn, cur):
+            logger.info("Create submission partition in DB: %s", partition.name)
+            await cur.execute(
+                sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF submissions FOR VALUES FROM ({}) TO ({})").format(
+                    sql.Identifier(partition.name),
+                    sql.Literal(lower_bound),
+                    sql.Literal(upper_bound),
+                )
+            )
+            await conn.commit()
+        return partition
+
+    async def compact_submission_partition(
+            self,
+            partition: SubmissionPartition,
+            keep_per_gallery: int,
+            *,
+            drop_archived: bool = False,
+    ) -> int:
+        """
+        Replaces a partition with a copy holding only the submissions which are still among the newest in their user's
+        gallery, and so can still appear in a gallery feed, SFW or otherwise. The original partition is detached and
+        moved to the archive schema, or dropped. Returns the number of submissions retained.
+        """
+        partition_table = sql.Identifier(partition.name)
+        retained_table = sql.Identifier(partition.retained_name)
+        lower = sql.SQL("MINVALUE") if partition.lower_bound is None else sql.Literal(partition.lower_bound)
+        upper = sql.SQL("MAXVALUE") if partition.upper_bound is None else sql.Literal(partition.upper_bound)
+        async with self.cursor("compact_submission_partition") as (conn, cur):
+            logger.info("Compact submission partition in DB: %s", partition.name)
+            await cur.execute("SET LOCAL lock_timeout = '10s'")
+            # Block writes to the partition while it is copied, but not reads
+            await cur.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(partition_table))
+            await cur.execute(
+                sql.SQL("CREATE TABLE {} (LIKE submissions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(retained_table)
+            )
+            await cur.execute(
+                sql.SQL(
+                    "INSERT INTO {retained} SELECT * FROM {partition} WHERE submission_id IN ("
+                    "  SELECT newest.submission_id"
+                    "  FROM (SELECT DISTINCT username, gallery FROM {partition}) AS galleries"
+                    "  CROSS JOIN LATERAL ("
+                    "   (SELECT submission_id FROM submissions"
+                    "    WHERE username = galleries.username AND gallery = galleries.gallery"
+                    "    ORDER BY submission_id DESC LIMIT %(keep)s)"
+                    "   UNION"
+                    "   (SELECT submission_id FROM submissions"
+                    "    WHERE username = galleries.username AND gallery = galleries.gallery AND {sfw_condition}"
+                    "    ORDER BY submission_id DESC LIMIT %(keep)s)"
+                    "  ) AS newest"
+                    " )"
+                ).format(
+                    retained=retained_table,
+                    partition=partition_table,
+                    sfw_condition=sql.SQL(SFW_CONDITION),
+                ),
+                {
+                    "keep": keep_per_gallery,
+                }
+            )
+            retained_count = cur.rowcount
+            # Build the retained table's indexes and prove its bound before touching the parent table, so that
+            # attaching it adopts the indexes rather than building them, and does not scan it, while holding the lock
+            # on submissions which every feed read waits for
+            await cur.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY (submission_id)").format(retained_table))
+            for index_suffix, index_def in SUBMISSION_PARTITION_INDEXES:
+                await cur.execute(
+                    sql.SQL("CREATE INDEX {} ON {} " + index_def).format(
+                        sql.Identifier(f"{partition.retained_name}_{index_suffix}"), retained_table,
+                    )
+                )
+            bound_checks = []
+            if partition.lower_bound is not None:
+                bound_checks.append(sql.SQL("submission_id >= {}").format(lower))
+            if partition.upper_bound is not None:
+                bound_checks.append(sql.SQL("submission_id < {}").format(upper))
+            bound_constraint = sql.Identifier(f"{partition.retained_name}_bound")
+            if bound_checks:
+                await cur.execute(
+                    sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK ({})").format(
+                        retained_table, bound_constraint, sql.SQL(" AND ").join(bound_checks),
+                    )
+                )
+            await cur.execute(sql.SQL("ALTER TABLE submissions DETACH PARTITION {}").format(partition_table))
+            await cur.execute(
+                sql.SQL("ALTER TABLE submissions ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+                    retained_table, lower, upper,
+                )
+            )
+            if bound_checks:
+                # The partition bound now enforces the same thing
+                await cur.execute(
+                    sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(retained_table, bound_constraint)
+                )
+            if drop_archived:
+                await cur.execute(sql.SQL("DROP TABLE {}").format(partition_table))
+            else:
+                await cur.execute(sql.SQL("ALTER TABLE {} SET SCHEMA archive").format(partition_table))
+            await conn.commit()
+        return retained_count
+
+    async def list_applied_migrations(self) -> set[int]:
+        async with self.cursor("list_applied_migrations") as (conn, cur):
+            await cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            await cur.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "  version integer NOT NULL PRIMARY KEY,"
+                "  name text NOT NULL,"
+                "  applied_at timestamptz NOT NULL DEFAULT now()"
+                ")"
+            )
+            await cur.execute("SELECT version FROM schema_migrations")
+            versions = {row["version"] for row in await cur.fetchall()}
+            await conn.commit()
+            return versions
+
+    async def list_recorded_migrations(self) -> set[int]:
+        """
+        Lists the applied migration versions without taking the migration lock or creating the schema_migrations table,
+        so that it is safe to call from read-only checks.
+        """
+        async with self.cursor("list_recorded_migrations") as (conn, cur):
+            await cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS exists")
+            row = await cur.fetchone()
+            if not row["exists"]:
+                return set()
+            await cur.execute("SELECT version FROM schema_migrations")
+            return {row["version"] for row in await cur.fetchall()}
+
+    async def apply_migration(self, version: int, name: str, migration_sql: str) -> bool:
+        """
+        Applies a schema migration and records it as applied, in a single transaction. Returns False if another process
+        applied the migration first.
+        """
+        async with self.cursor("apply_migration") as (conn, cur):
+            await cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            await cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if await cur.fetchone() is not None:
+                await conn.rollback()
+                return False
+            logger.info("Applying database migration %s: %s", version, name)
+            await cur.execute(migration_sql)
+            await cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            await conn.commit()
+            return True
+
+    async def explain_query(self, query: str, params: dict) -> dict:
+        """
+        Returns the JSON plan for a query. Sequential scans and sorts are disabled while planning, so that even on a
+        small database the plan shows whether an index can serve the query, rather than what is cheapest for a few rows.
+        """
+        async with self.cursor("explain_query") as (conn, cur):
+            await cur.execute("SET LOCAL enable_seqscan = off")
+            await cur.execute("SET LOCAL enable_sort = off")
+            await cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            row = await cur.fetchone()
+            await conn.rollback()
+            return row["QUERY PLAN"][0]["Plan"]
+
+    async def get_root_index_names(self, index_names: set[str]) -> set[str]:
+        """
+        Maps the names of indexes on submission partitions to the partitioned indexes they belong to
+        """
+        async with self.cursor("get_root_index_names") as (conn, cur):
+            await cur.execute(
+                "SELECT coalesce(pg_partition_root(oid), oid)::regclass::text AS root_name FROM pg_class"
+                " WHERE relname = ANY(%s) AND relkind IN ('i', 'I')",
+                (list(index_names),)
+            )
+            return {row["root_name"] for row in await cur.fetchall()}
+
+    @staticmethod
+    async def _notify_setting_changed(cur: AsyncCursor, setting_key: str, setting_value: str) -> None:
+        # Notifications are only delivered when the transaction commits
+        await cur.execute(
+            "SELECT pg_notify(%s, %s)",
+            (SETTINGS_CHANGED, json.dumps({"key": setting_key, "value": setting_value}))
+        )
+
+    async def list_setting_values(self) -> dict[str, Optional[str]]:
+        async with self.cursor("list_setting_values") as (conn, cur):
+            logger.info("List settings from DB")
+            await cur.execute("SELECT key, value FROM settings")
+            return {row["key"]: row["value"] for row in await cur.fetchall()}
+
     async def get_setting_value(self, setting_key: str) -> Optional[str]:
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("get_setting_value") as (conn, cur):
             logger.info("Fetch setting from DB")
             await cur.execute("SELECT value FROM settings WHERE key = %s", (setting_key,))
             result = await cur.fetchone()
@@ -180,10 +860,11 @@ class Database:
             return result["value"]
 
     async def set_setting_value(self, setting_key: str, setting_value: str) -> None:
-        async with self.cursor() as (conn, cur):
+        async with self.cursor("set_setting_value") as (conn, cur):
             logger.info("Updating setting in DB")
             await cur.execute(
                 "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = %s",
                 (setting_key, setting_value, setting_value)
             )
+            await self._notify_setting_changed(cur, setting_key, setting_value)
             await conn.commit()
@@ -10,7 +10,7 @@ CREATE TABLE IF NOT EXISTS "submissions" (
   "rating" text NOT NULL,
   "keywords" text[] NOT NULL
 );
-CREATE INDEX "submissions_username_gallery" ON "submissions" ("username", "gallery");
+CREATE INDEX IF NOT EXISTS "submissions_username_gallery" ON "submissions" ("username", "gallery");
 
 CREATE TABLE IF NOT EXISTS "users" (
   "username" text NOT NULL PRIMARY KEY,
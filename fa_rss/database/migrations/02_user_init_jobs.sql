@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS "user_init_jobs" (
+  "username" text NOT NULL PRIMARY KEY,
+  "priority" integer NOT NULL DEFAULT 0,
+  "attempts" integer NOT NULL DEFAULT 0,
+  "run_after" timestamptz NOT NULL DEFAULT now(),
+  "locked_until" timestamptz,
+  "last_error" text,
+  "created_at" timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS "user_init_jobs_priority_run_after" ON "user_init_jobs" ("priority" DESC, "run_after");
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS "submission_gaps" (
+  "submission_id" integer NOT NULL PRIMARY KEY,
+  "attempts" integer NOT NULL DEFAULT 0,
+  "next_retry_at" timestamptz NOT NULL,
+  "last_error" text,
+  "failed" boolean NOT NULL DEFAULT false
+);
+CREATE INDEX IF NOT EXISTS "submission_gaps_next_retry_at" ON "submission_gaps" ("next_retry_at") WHERE NOT "failed";
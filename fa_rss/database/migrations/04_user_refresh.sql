@@ -0,0 +1,3 @@
+ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "last_refreshed" timestamptz;
+ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "last_requested" timestamptz;
+ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "requests_since_refresh" integer NOT NULL DEFAULT 0;
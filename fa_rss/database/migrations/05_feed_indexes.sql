@@ -0,0 +1,12 @@
+-- Gallery feeds filter on user and gallery, and list the newest submissions first, so can be read straight off the
+-- end of this index without a sort
+CREATE INDEX IF NOT EXISTS "submissions_username_gallery_id" ON "submissions" ("username", "gallery", "submission_id" DESC);
+-- SFW feeds have their own partial indexes, on the rating in SFW_RATING, so they do not skip past every non-SFW submission
+CREATE INDEX IF NOT EXISTS "submissions_username_gallery_id_sfw" ON "submissions" ("username", "gallery", "submission_id" DESC)
+  WHERE "rating" = 'General';
+CREATE INDEX IF NOT EXISTS "submissions_id_sfw" ON "submissions" ("submission_id" DESC) WHERE "rating" = 'General';
+-- Superseded by submissions_username_gallery_id, which covers the same prefix
+DROP INDEX IF EXISTS "submissions_username_gallery";
+
+-- The refresh scheduler only considers users whose feeds have been requested since their last refresh
+CREATE INDEX IF NOT EXISTS "users_requested_since_refresh" ON "users" ("username") WHERE "requests_since_refresh" > 0;
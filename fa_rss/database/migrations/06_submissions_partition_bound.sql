@@ -0,0 +1,18 @@
+-- Bounds the existing submissions table below the ID where partitioning will start, so that it can later be attached
+-- as a partition without a full scan under an exclusive lock. The constraint is added NOT VALID, which only needs a
+-- brief lock, and is validated by the next migration. The bound leaves a million IDs of headroom above the next
+-- million, as new submissions can still be saved until the table is partitioned.
+DO $$
+DECLARE
+  legacy_upper_bound bigint;
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'submissions'::regclass)
+      OR EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'submissions_legacy_bound') THEN
+    RETURN;
+  END IF;
+  SELECT (coalesce(max("submission_id"), 0) / 1000000 + 2) * 1000000 INTO legacy_upper_bound FROM "submissions";
+  EXECUTE format(
+    'ALTER TABLE "submissions" ADD CONSTRAINT "submissions_legacy_bound" CHECK ("submission_id" < %s) NOT VALID',
+    legacy_upper_bound
+  );
+END $$;
@@ -0,0 +1,7 @@
+-- Validating scans the whole table, but only blocks schema changes, so feeds are still served and submissions saved
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'submissions_legacy_bound' AND NOT convalidated) THEN
+    ALTER TABLE "submissions" VALIDATE CONSTRAINT "submissions_legacy_bound";
+  END IF;
+END $$;
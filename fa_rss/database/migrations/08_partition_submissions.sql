@@ -0,0 +1,51 @@
+-- Submissions are partitioned by submission ID range, so that cold ranges can be compacted or archived a partition at a
+-- time. The existing table becomes a single partition, covering every ID below the bound validated by the previous
+-- migrations, and partitions beyond that are created by the data fetcher as the latest submission ID advances.
+CREATE SCHEMA IF NOT EXISTS "archive";
+
+DO $$
+DECLARE
+  legacy_upper_bound bigint;
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'submissions'::regclass) THEN
+    RETURN;
+  END IF;
+  SELECT substring(pg_get_constraintdef("oid") FROM '<\s*(\d+)')::bigint INTO legacy_upper_bound
+    FROM pg_constraint WHERE conname = 'submissions_legacy_bound' AND convalidated;
+  IF legacy_upper_bound IS NULL THEN
+    RAISE EXCEPTION 'Submissions table has no validated partition bound constraint';
+  END IF;
+
+  ALTER TABLE "submissions" RENAME TO "submissions_legacy";
+  ALTER INDEX "submissions_pkey" RENAME TO "submissions_legacy_pkey";
+  ALTER INDEX "submissions_username_gallery_id" RENAME TO "submissions_legacy_username_gallery_id";
+  ALTER INDEX "submissions_username_gallery_id_sfw" RENAME TO "submissions_legacy_username_gallery_id_sfw";
+  ALTER INDEX "submissions_id_sfw" RENAME TO "submissions_legacy_id_sfw";
+
+  CREATE TABLE "submissions" (
+    "submission_id" integer NOT NULL,
+    "username" text NOT NULL,
+    "gallery" text NOT NULL,
+    "title" text NOT NULL,
+    "description" text NOT NULL,
+    "download_url" text NOT NULL,
+    "thumbnail_url" text,
+    "posted_at" timestamptz NOT NULL,
+    "rating" text NOT NULL,
+    "keywords" text[] NOT NULL,
+    PRIMARY KEY ("submission_id")
+  ) PARTITION BY RANGE ("submission_id");
+  CREATE INDEX "submissions_username_gallery_id" ON "submissions" ("username", "gallery", "submission_id" DESC);
+  CREATE INDEX "submissions_username_gallery_id_sfw" ON "submissions" ("username", "gallery", "submission_id" DESC)
+    WHERE "rating" = 'General';
+  CREATE INDEX "submissions_id_sfw" ON "submissions" ("submission_id" DESC) WHERE "rating" = 'General';
+
+  -- The legacy table's indexes match the new ones, so are attached to them rather than rebuilt, and its bound
+  -- constraint proves it fits the partition, so it is not scanned
+  EXECUTE format(
+    'ALTER TABLE "submissions" ATTACH PARTITION "submissions_legacy" FOR VALUES FROM (MINVALUE) TO (%s)',
+    legacy_upper_bound
+  );
+  -- The partition bound now enforces the same thing
+  ALTER TABLE "submissions_legacy" DROP CONSTRAINT "submissions_legacy_bound";
+END $$;
@@ -0,0 +1,8 @@
+-- Token bucket shared by every process making requests to the FAExport API, so that their combined load stays within
+-- one budget. Tokens are refilled lazily, from the time since the bucket was last updated, whenever one is taken.
+CREATE TABLE IF NOT EXISTS "api_budget" (
+  "name" text NOT NULL PRIMARY KEY,
+  "tokens" double precision NOT NULL,
+  "updated_at" timestamptz NOT NULL DEFAULT now()
+);
+INSERT INTO "api_budget" ("name", "tokens") VALUES ('faexport', 0) ON CONFLICT ("name") DO NOTHING;
@@ -0,0 +1,4 @@
+-- When each submission's contents last changed, so that feed validators change when a submission in the feed is edited,
+-- not only when one is added or removed. Existing rows take the time of the migration, which adds the column without
+-- rewriting the table.
+ALTER TABLE "submissions" ADD COLUMN IF NOT EXISTS "updated_at" timestamptz NOT NULL DEFAULT now();
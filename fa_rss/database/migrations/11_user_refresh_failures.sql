@@ -0,0 +1,4 @@
+-- Users whose refresh keeps failing are backed off, so that the refresh scheduler does not keep picking them over
+-- everyone else
+ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "refresh_failures" integer NOT NULL DEFAULT 0;
+ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "next_refresh_after" timestamptz;
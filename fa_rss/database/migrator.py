@@ -0,0 +1,65 @@
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+from fa_rss.database.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    path: Path
+
+    def read_sql(self) -> str:
+        return self.path.read_text()
+
+
+class Migrator:
+    """
+    Applies the numbered SQL files in the migrations directory, in order, recording each applied version in the
+    schema_migrations table. Migrations are all written to be idempotent, so a database which was set up by hand before
+    the table existed can be brought under management by running them all.
+    """
+    MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+    MIGRATION_FILE_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+
+    def list_migrations(self) -> list[Migration]:
+        migrations = []
+        for path in self.MIGRATIONS_DIR.iterdir():
+            match = self.MIGRATION_FILE_PATTERN.match(path.name)
+            if match is None:
+                continue
+            migrations.append(Migration(int(match.group(1)), match.group(2), path))
+        migrations.sort(key=lambda migration: migration.version)
+        versions = [migration.version for migration in migrations]
+        if len(set(versions)) != len(versions):
+            raise ValueError(f"Duplicate database migration versions: {versions}")
+        return migrations
+
+    async def list_pending_migrations(self) -> list[Migration]:
+        """
+        Lists the migrations which have not yet been applied, without changing the database.
+        """
+        applied_versions = await self.db.list_recorded_migrations()
+        return [migration for migration in self.list_migrations() if migration.version not in applied_versions]
+
+    async def migrate(self) -> list[Migration]:
+        applied_versions = await self.db.list_applied_migrations()
+        applied = []
+        for migration in self.list_migrations():
+            if migration.version in applied_versions:
+                continue
+            if await self.db.apply_migration(migration.version, migration.name, migration.read_sql()):
+                applied.append(migration)
+        if applied:
+            logger.info("Applied %s database migrations", len(applied))
+        else:
+            logger.info("Database schema is up to date")
+        return applied
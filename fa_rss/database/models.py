@@ -1,11 +1,123 @@
 import datetime
+import re
 from dataclasses import dataclass
+from typing import Optional
+
+from fa_rss.faexport.models import Submission
 
 
 @dataclass
 class User:
     username: str
     date_initialised: datetime.datetime
+    last_refreshed: Optional[datetime.datetime] = None
+    refresh_failures: int = 0
     
     def __post_init__(self):
         self.username = self.username.lower()
+
+
+@dataclass
+class FeedVersion:
+    latest_submission_id: Optional[int]
+    oldest_submission_id: Optional[int]
+    submission_count: int
+    last_posted_at: Optional[datetime.datetime]
+    # When a submission in the feed was last saved with changes, so that edits also change the version
+    last_updated_at: Optional[datetime.datetime] = None
+
+    @property
+    def etag(self) -> str:
+        revision = int(self.last_updated_at.timestamp() * 1_000_000) if self.last_updated_at is not None else 0
+        return f"{self.submission_count}-{self.oldest_submission_id or 0}-{self.latest_submission_id or 0}-{revision}"
+
+    @property
+    def last_modified(self) -> Optional[datetime.datetime]:
+        times = [time for time in [self.last_posted_at, self.last_updated_at] if time is not None]
+        return max(times, default=None)
+
+
+@dataclass
+class SubmissionChange:
+    """
+    The parts of a saved or deleted submission which decide which feeds it belongs in, as sent to other processes.
+    If the submission was already stored, its previous gallery and rating are included, as it may be leaving feeds too.
+    """
+    submission_id: int
+    username: str
+    gallery: str
+    rating: str
+    previous_gallery: Optional[str] = None
+    previous_rating: Optional[str] = None
+
+    @classmethod
+    def from_submission(
+            cls,
+            submission: Submission,
+            previous: Optional[tuple[str, str]] = None,
+    ) -> "SubmissionChange":
+        previous_gallery, previous_rating = previous if previous is not None else (None, None)
+        return cls(
+            submission.submission_id,
+            submission.username,
+            submission.gallery,
+            submission.rating,
+            previous_gallery,
+            previous_rating,
+        )
+
+    def placements(self) -> list[tuple[str, str]]:
+        """
+        The gallery and rating the submission had before the change, if known, and has after it
+        """
+        current = (self.gallery, self.rating)
+        if self.previous_gallery is None or self.previous_rating is None:
+            return [current]
+        previous = (self.previous_gallery, self.previous_rating)
+        return [current] if previous == current else [previous, current]
+
+
+@dataclass
+class UserInitJob:
+    username: str
+    priority: int
+    attempts: int
+
+
+@dataclass
+class SubmissionGap:
+    submission_id: int
+    attempts: int
+    next_retry_at: datetime.datetime
+    last_error: Optional[str]
+
+
+@dataclass
+class SubmissionPartition:
+    # Suffix given to partitions which have been compacted down to the submissions still shown in feeds
+    RETAINED_SUFFIX = "_retained"
+    BOUND_PATTERN = re.compile(r"FROM \((\w+)\) TO \((\w+)\)")
+
+    name: str
+    lower_bound: Optional[int]
+    upper_bound: Optional[int]
+
+    @classmethod
+    def from_partition_bound(cls, name: str, bound_expr: str) -> "SubmissionPartition":
+        match = cls.BOUND_PATTERN.search(bound_expr)
+        if match is None:
+            raise ValueError(f"Unrecognised submission partition bound for {name}: {bound_expr}")
+        lower, upper = match.groups()
+        return cls(
+            name,
+            None if lower == "MINVALUE" else int(lower),
+            None if upper == "MAXVALUE" else int(upper),
+        )
+
+    @property
+    def is_retained(self) -> bool:
+        return self.name.endswith(self.RETAINED_SUFFIX)
+
+    @property
+    def retained_name(self) -> str:
+        return f"{self.name}{self.RETAINED_SUFFIX}"
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from typing import Callable, Awaitable, Optional
+
+import psycopg
+from prometheus_client import Counter, Gauge
+from psycopg import AsyncConnection, sql
+
+logger = logging.getLogger(__name__)
+
+listener_connected = Gauge(
+    "farss_database_notification_listener_connected",
+    "Whether the database notification listener is currently connected and listening (1) or not (0)",
+)
+notifications_received = Counter(
+    "farss_database_notifications_received_count",
+    "Number of database change notifications received, by channel",
+    ["channel"],
+)
+
+# Notification channels
+SETTINGS_CHANGED = "farss_settings_changed"
+SUBMISSION_CHANGED = "farss_submission_changed"
+USER_INITIALISED = "farss_user_initialised"
+
+
+class NotificationListener:
+    """
+    Listens for Postgres notifications on a dedicated connection, and passes each one to the handlers registered for its
+    channel, so that in-process caches can be kept up to date with changes made by other processes.
+    Notifications sent while the listener is disconnected are lost, so reconnect handlers are called every time it
+    connects, for caches to reload. Handlers must be added before the listener is started.
+    """
+    RECONNECT_DELAY_SECONDS = 5
+
+    def __init__(self, conn_string: str) -> None:
+        self.conn_string = conn_string
+        self.connected = False
+        self._handlers: dict[str, list[Callable[[str], None]]] = {}
+        self._reconnect_handlers: list[Callable[[], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def add_handler(self, channel: str, handler: Callable[[str], None]) -> None:
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def add_reconnect_handler(self, handler: Callable[[], Awaitable[None]]) -> None:
+        self._reconnect_handlers.append(handler)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._set_connected(False)
+
+    def _set_connected(self, connected: bool) -> None:
+        self.connected = connected
+        listener_connected.set(int(connected))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except (psycopg.Error, OSError) as e:
+                logger.warning("Database notification listener disconnected, will reconnect", exc_info=e)
+            self._set_connected(False)
+            await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+
+    async def _listen(self) -> None:
+        async with await AsyncConnection.connect(self.conn_string, autocommit=True) as conn:
+            for channel in self._handlers:
+                await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            logger.info("Listening for database notifications on %s channels", len(self._handlers))
+            # Notifications arriving while caches reload are queued on the connection, and handled afterwards
+            for reconnect_handler in self._reconnect_handlers:
+                await reconnect_handler()
+            self._set_connected(True)
+            async for notify in conn.notifies():
+                notifications_received.labels(channel=notify.channel).inc()
+                for handler in self._handlers.get(notify.channel, []):
+                    try:
+                        handler(notify.payload)
+                    except Exception as e:
+                        logger.error("Failed to handle database notification on %s", notify.channel, exc_info=e)
@@ -0,0 +1,79 @@
+import logging
+from dataclasses import dataclass
+
+from fa_rss.database.database import (
+    Database, recent_submissions_query, user_gallery_submissions_query, feed_version_query,
+)
+
+logger = logging.getLogger(__name__)
+
+# Plan nodes which mean a feed query is not being served as a range scan of its index
+UNWANTED_PLAN_NODES = {"Seq Scan", "Sort", "Incremental Sort", "Bitmap Heap Scan", "Merge Append"}
+
+
+@dataclass
+class QueryPlanCheck:
+    name: str
+    query: str
+    expected_index: str
+
+
+def _feed_query_checks() -> list[QueryPlanCheck]:
+    checks = []
+    for sfw_mode in [False, True]:
+        suffix = " (SFW)" if sfw_mode else ""
+        recent_index = "submissions_id_sfw" if sfw_mode else "submissions_pkey"
+        gallery_index = "submissions_username_gallery_id_sfw" if sfw_mode else "submissions_username_gallery_id"
+        version_columns = "submission_id, posted_at, updated_at"
+        checks += [
+            QueryPlanCheck(
+                f"Recent submissions feed{suffix}",
+                recent_submissions_query("*", sfw_mode),
+                recent_index,
+            ),
+            QueryPlanCheck(
+                f"Recent submissions feed version{suffix}",
+                feed_version_query(recent_submissions_query(version_columns, sfw_mode)),
+                recent_index,
+            ),
+            QueryPlanCheck(
+                f"User gallery feed{suffix}",
+                user_gallery_submissions_query("*", sfw_mode),
+                gallery_index,
+            ),
+            QueryPlanCheck(
+                f"User gallery feed version{suffix}",
+                feed_version_query(user_gallery_submissions_query(version_columns, sfw_mode)),
+                gallery_index,
+            ),
+        ]
+    return checks
+
+
+def _plan_nodes(plan: dict) -> list[dict]:
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes.extend(_plan_nodes(child))
+    return nodes
+
+
+async def check_feed_query_plans(db: Database) -> list[str]:
+    """
+    Explains each of the feed queries against the database, and returns a description of each one which is not planned
+    as a scan of its expected index, so that a changed query or a missing index is caught before it reaches production.
+    """
+    params = {"username": "fender", "gallery": "gallery", "limit": 20}
+    problems = []
+    for check in _feed_query_checks():
+        plan = await db.explain_query(check.query, params)
+        nodes = _plan_nodes(plan)
+        node_types = [node["Node Type"] for node in nodes]
+        # Submissions are partitioned, so each partition's index is mapped back to the index on the whole table
+        index_names = await db.get_root_index_names({node["Index Name"] for node in nodes if "Index Name" in node})
+        logger.info("Query plan for %s: %s", check.name, " -> ".join(node_types))
+        unwanted = UNWANTED_PLAN_NODES.intersection(node_types)
+        if unwanted:
+            problems.append(f"{check.name}: plan contains {', '.join(sorted(unwanted))}")
+        if check.expected_index not in index_names:
+            problems.append(f"{check.name}: plan does not use index {check.expected_index}")
+    return problems
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+
+from prometheus_client import Gauge, Counter
+
+logger = logging.getLogger(__name__)
+
+effective_rate = Gauge(
+    "farss_faexport_adaptive_rate_limit",
+    "Current requests per second allowed by the adaptive FAExport API rate limiter",
+    ["limiter"],
+)
+rate_decreases = Counter(
+    "farss_faexport_adaptive_rate_decrease_count",
+    "Number of times the adaptive FAExport API rate limiter backed off, due to slowdown, cloudflare or host errors",
+    ["limiter"],
+)
+
+
+class AdaptiveLimiter:
+    """
+    Rate limiter which adapts its rate to how FA is coping, by additive increase and multiplicative decrease. Each
+    successful response raises the rate slightly, by about increase_per_second every second at full use, up to the
+    maximum. Each slowdown or overload response cuts the rate by decrease_factor, down to the minimum. Backoffs within
+    the cooldown of the last one are ignored, as they are usually from requests sent before it.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            *,
+            initial_rate: float,
+            min_rate: float,
+            max_rate: float,
+            increase_per_second: float = 0.02,
+            decrease_factor: float = 0.5,
+            decrease_cooldown: float = 10,
+    ) -> None:
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_per_second = increase_per_second
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.rate = min(max(initial_rate, min_rate), max_rate)
+        self._next_slot = 0.0
+        self._last_decrease = float("-inf")
+        effective_rate.labels(limiter=name).set(self.rate)
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def record_success(self) -> None:
+        if self.rate >= self.max_rate:
+            return
+        # Each success adds increase/rate, so the rate climbs at about increase_per_second per second at any rate
+        self.rate = min(self.max_rate, self.rate + self.increase_per_second / self.rate)
+        effective_rate.labels(limiter=self.name).set(self.rate)
+
+    def record_backoff(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        logger.warning("FAExport API rate limiter %s backing off to %.2f requests per second", self.name, self.rate)
+        rate_decreases.labels(limiter=self.name).inc()
+        effective_rate.labels(limiter=self.name).set(self.rate)
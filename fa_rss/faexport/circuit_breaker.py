@@ -0,0 +1,99 @@
+import logging
+import time
+from typing import Optional
+
+from prometheus_client import Gauge, Counter
+
+from fa_rss.faexport.errors import FAExportCircuitOpen
+
+logger = logging.getLogger(__name__)
+
+circuit_open = Gauge(
+    "farss_faexport_circuit_breaker_open",
+    "Whether the circuit breaker is open (1), failing requests fast, or closed (0)",
+    ["breaker"],
+)
+circuit_trips = Counter(
+    "farss_faexport_circuit_breaker_trip_count",
+    "Number of times the circuit breaker has opened, after consecutive upstream failures",
+    ["breaker"],
+)
+circuit_rejected = Counter(
+    "farss_faexport_circuit_breaker_rejected_count",
+    "Number of requests failed fast because the circuit breaker was open",
+    ["breaker"],
+)
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to the FAExport API after a run of consecutive failures showing FA or the API host is down,
+    so that callers fail fast rather than each waiting out their own timeouts.
+    Once the reset timeout has passed, a single trial request is let through. If it succeeds the breaker closes,
+    otherwise it stays open for another reset timeout.
+    """
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_RESET_TIMEOUT_SECONDS = 30
+
+    def __init__(
+            self,
+            name: str,
+            *,
+            failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+            reset_timeout: float = DEFAULT_RESET_TIMEOUT_SECONDS,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        # When the current trial request was let through. A trial which never reports back expires after the timeout.
+        self._trial_started_at: Optional[float] = None
+        circuit_open.labels(breaker=name).set(0)
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0
+        return max(self._opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    def check(self) -> None:
+        """
+        Raises FAExportCircuitOpen if a request should not be sent right now
+        """
+        if self._opened_at is None:
+            return
+        now = time.monotonic()
+        trial_running = self._trial_started_at is not None and self._trial_started_at + self.reset_timeout > now
+        if now < self._opened_at + self.reset_timeout or trial_running:
+            circuit_rejected.labels(breaker=self.name).inc()
+            retry_after = max(self.retry_after(), 1)
+            raise FAExportCircuitOpen(f"Circuit breaker {self.name} is open, retry in {retry_after:.0f}s", retry_after)
+        logger.info("Circuit breaker %s letting a trial request through", self.name)
+        self._trial_started_at = now
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Circuit breaker %s closing, trial request succeeded", self.name)
+            circuit_open.labels(breaker=self.name).set(0)
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_started_at = None
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        self._trial_started_at = None
+        if self._opened_at is not None:
+            # The trial request failed, so stay open for another reset timeout
+            self._opened_at = time.monotonic()
+            return
+        if self._consecutive_failures >= self.failure_threshold:
+            logger.warning(
+                "Circuit breaker %s opening after %s consecutive failures", self.name, self._consecutive_failures
+            )
+            self._opened_at = time.monotonic()
+            circuit_open.labels(breaker=self.name).set(1)
+            circuit_trips.labels(breaker=self.name).inc()
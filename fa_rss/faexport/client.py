@@ -1,18 +1,115 @@
 import asyncio
 import logging
-from typing import Any, Optional
+import re
+import time
+from types import SimpleNamespace
+from typing import Any, Optional, Union, TYPE_CHECKING
 
 import aiohttp
 from aiohttp.client_exceptions import ContentTypeError
 import dateutil.parser
 from aiolimiter import AsyncLimiter
+from prometheus_client import Counter, Histogram
 
-from fa_rss.faexport.errors import from_error_data, FAExportClientError, FASlowdown, FAExportAPIError, FAExportHostUnavailable
+from fa_rss.faexport.adaptive_limiter import AdaptiveLimiter
+from fa_rss.faexport.circuit_breaker import CircuitBreaker
+from fa_rss.faexport.errors import from_error_data, FAExportClientError, FASlowdown, FAExportAPIError, \
+    FAExportHostUnavailable, FACloudflareError
 from fa_rss.faexport.models import Submission, SiteStatus, SubmissionPreview
-from fa_rss.faexport.slowdown import FASlowdownState
+from fa_rss.faexport.priority import ApiPriority, api_priority
+from fa_rss.faexport.slowdown import FASlowdownState, SlowdownStatusPoller
+
+if TYPE_CHECKING:
+    from fa_rss.api_budget import SharedApiBudget
 
 logger = logging.getLogger(__name__)
 
+connections_created = Counter(
+    "farss_faexport_connections_created_count",
+    "Number of new connections opened to the FAExport API",
+)
+connections_reused = Counter(
+    "farss_faexport_connections_reused_count",
+    "Number of requests to the FAExport API which reused a pooled keep-alive connection",
+)
+coalesced_requests = Counter(
+    "farss_faexport_coalesced_request_count",
+    "Number of FAExport API calls which were served by sharing an identical request already in flight",
+)
+connection_queue_wait_time = Histogram(
+    "farss_faexport_connection_queue_wait_seconds",
+    "Time spent waiting for a free connection in the FAExport API connection pool",
+)
+request_duration = Histogram(
+    "farss_faexport_request_duration_seconds",
+    "Time taken by FAExport API requests, not including rate limiter waits, by endpoint and outcome",
+    ["endpoint", "outcome"],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+)
+limiter_wait_time = Histogram(
+    "farss_faexport_limiter_wait_seconds",
+    "Time FAExport API requests spent waiting on rate limiters before being sent, by limiter",
+    ["limiter"],
+    buckets=[0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60],
+)
+# Errors which mean FA or the FAExport host is struggling, so an adaptive limiter should back off
+BACKOFF_ERRORS = (FASlowdown, FACloudflareError, FAExportHostUnavailable)
+# Errors which mean FA or the FAExport host is down, so count towards opening a circuit breaker
+CIRCUIT_BREAKER_ERRORS = (FACloudflareError, FAExportHostUnavailable, aiohttp.ClientConnectionError, TimeoutError)
+# Path segments which vary per request, replaced with placeholders to give a bounded set of endpoint labels
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^/user/[^/]+/"), "/user/{username}/"),
+    (re.compile(r"^/submission/\d+"), "/submission/{id}"),
+]
+
+
+async def _on_connection_create_end(
+        session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionCreateEndParams,
+) -> None:
+    connections_created.inc()
+
+
+async def _on_connection_reuseconn(
+        session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionReuseconnParams,
+) -> None:
+    connections_reused.inc()
+
+
+async def _on_connection_queued_start(
+        session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionQueuedStartParams,
+) -> None:
+    trace_config_ctx.queued_at = asyncio.get_running_loop().time()
+
+
+async def _on_connection_queued_end(
+        session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: aiohttp.TraceConnectionQueuedEndParams,
+) -> None:
+    connection_queue_wait_time.observe(asyncio.get_running_loop().time() - trace_config_ctx.queued_at)
+
+
+def _pool_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_connection_queued_start.append(_on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(_on_connection_queued_end)
+    return trace_config
+
+
+def _endpoint_label(path: str) -> str:
+    endpoint = path.split("?", 1)[0]
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        endpoint = pattern.sub(replacement, endpoint)
+    return endpoint
+
 
 def _sfw_param(sfw_mode: bool, first_param: bool = True) -> str:
     connector = "?" if first_param else "&"
@@ -25,24 +122,107 @@ class FAExportClient:
             self,
             url: str,
             *,
-            limiter: Optional[AsyncLimiter] = None,
+            limiter: Optional[Union[AsyncLimiter, AdaptiveLimiter]] = None,
             slowdown_limiter: Optional[AsyncLimiter] = AsyncLimiter(1, 2),
+            slowdown_poller: Optional[SlowdownStatusPoller] = None,
+            budget: Optional["SharedApiBudget"] = None,
+            default_priority: ApiPriority = ApiPriority.INGEST,
+            circuit_breaker: Optional[CircuitBreaker] = None,
             max_attempts: int = 7,
+            connection_limit: int = 20,
+            connection_limit_per_host: int = 10,
+            dns_cache_seconds: int = 300,
+            request_timeout: float = 120,
+            connect_timeout: float = 10,
     ) -> None:
         self.url = url.rstrip("/")
-        self.session = aiohttp.ClientSession(self.url)
-        self.slowdown = FASlowdownState(self, slowdown_limiter)
+        self.slowdown = FASlowdownState(self, slowdown_limiter, slowdown_poller)
         self.limiter = limiter
+        self.budget = budget
+        self.default_priority = default_priority
+        self.circuit_breaker = circuit_breaker
         self.max_attempts = max_attempts
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.dns_cache_seconds = dns_cache_seconds
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout)
+        # The session must be created inside the running event loop, so it is created on first use
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Requests currently in flight, by path and priority, so that identical concurrent requests can share one upstream
+        # request
+        self._in_flight: dict[tuple[str, ApiPriority], asyncio.Task] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                ttl_dns_cache=self.dns_cache_seconds,
+            )
+            self._session = aiohttp.ClientSession(
+                self.url,
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[_pool_trace_config()],
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self.slowdown.poller.client is self:
+            await self.slowdown.poller.stop()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     async def _make_request(self, session: aiohttp.ClientSession, path: str) -> Any:
+        # If FA or the API host has been failing, fail fast rather than queue up behind the limiters
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check()
         # If a limiter is given, then slowdown
         if self.limiter is not None:
-            await self.limiter.acquire()
+            with limiter_wait_time.labels(limiter="rate_limit").time():
+                await self.limiter.acquire()
         # If FA is in slowdown state, then slow requests a bit more
         if "status.json" not in path:
-            await self.slowdown.wait_if_needed()
+            with limiter_wait_time.labels(limiter="slowdown").time():
+                await self.slowdown.wait_if_needed()
+        # Take a token from the budget shared with other processes, at the priority of whoever is asking
+        if self.budget is not None:
+            await self.budget.acquire(api_priority.get() or self.default_priority)
         # Make the request
+        endpoint = _endpoint_label(path)
+        request_start = time.monotonic()
+        try:
+            data = await self._get_json(session, path)
+        except Exception as e:
+            request_duration.labels(endpoint=endpoint, outcome=type(e).__name__).observe(time.monotonic() - request_start)
+            self._adapt_rate(e)
+            self._record_circuit_outcome(e)
+            raise
+        request_duration.labels(endpoint=endpoint, outcome="success").observe(time.monotonic() - request_start)
+        self._adapt_rate(None)
+        self._record_circuit_outcome(None)
+        return data
+
+    def _record_circuit_outcome(self, error: Optional[Exception]) -> None:
+        if self.circuit_breaker is None:
+            return
+        if isinstance(error, CIRCUIT_BREAKER_ERRORS):
+            self.circuit_breaker.record_failure()
+        elif error is None or isinstance(error, FAExportAPIError):
+            self.circuit_breaker.record_success()
+
+    def _adapt_rate(self, error: Optional[Exception]) -> None:
+        if not isinstance(self.limiter, AdaptiveLimiter):
+            return
+        if isinstance(error, BACKOFF_ERRORS):
+            self.limiter.record_backoff()
+        # Other API errors, such as a submission not being found, still mean FA is responding normally
+        elif error is None or isinstance(error, FAExportAPIError):
+            self.limiter.record_success()
+
+    async def _get_json(self, session: aiohttp.ClientSession, path: str) -> Any:
         async with session.get(path) as resp:
             try:
                 data = await resp.json()
@@ -58,20 +238,36 @@ class FAExportClient:
             return data
 
     async def _request_with_retry(self, path: str) -> Any:
+        # The shared request takes its budget token at the priority of the caller which started it, so only callers of
+        # the same priority share it, rather than leaving a higher priority caller waiting on a lower priority's reserve
+        key = (path, api_priority.get() or self.default_priority)
+        request_task = self._in_flight.get(key)
+        if request_task is not None:
+            logger.debug("Identical FAExport request already in flight, sharing its result")
+            coalesced_requests.inc()
+        else:
+            request_task = asyncio.create_task(self._request_with_retry_uncoalesced(path))
+            self._in_flight[key] = request_task
+            request_task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shield the shared request, so that one caller being cancelled does not cancel it for the others
+        return await asyncio.shield(request_task)
+
+    async def _request_with_retry_uncoalesced(self, path: str) -> Any:
         attempts = 0
         last_exception = None
-        async with aiohttp.ClientSession(self.url) as session:
-            while attempts < self.max_attempts:
-                try:
-                    return await self._make_request(session, path)
-                except FASlowdown as e:
-                    logger.debug("FA returned slowdown error to FAExport API, retrying")
-                    attempts += 1
-                    last_exception = e
+        while attempts < self.max_attempts:
+            try:
+                return await self._make_request(self.session, path)
+            except FASlowdown as e:
+                logger.debug("FA returned slowdown error to FAExport API, retrying")
+                attempts += 1
+                last_exception = e
+                # An adaptive limiter has already slowed down, so retries are paced by that instead
+                if not isinstance(self.limiter, AdaptiveLimiter):
                     await asyncio.sleep(2**attempts)
-                except FAExportAPIError as e:
-                    logger.warning("FAExport API request failed with exception: ", exc_info=e)
-                    raise e
+            except FAExportAPIError as e:
+                logger.warning("FAExport API request failed with exception: ", exc_info=e)
+                raise e
         if last_exception:
             raise last_exception
         raise FAExportClientError("Could not make any requests to FAExport API")
@@ -41,6 +41,12 @@ class FAExportClientError(FAExportError):
         return f"{type(self).__name__}({self.msg})"
 
 
+class FAExportCircuitOpen(FAExportClientError):
+    def __init__(self, msg: str, retry_after: float) -> None:
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
 class UnrecognisedError(FAExportAPIError):
     def __init__(self, err_type: str, msg: str, fa_url: Optional[str], api_path: str) -> None:
         super().__init__(msg, fa_url, api_path)
@@ -0,0 +1,17 @@
+import enum
+from contextvars import ContextVar
+from typing import Optional
+
+
+class ApiPriority(enum.Enum):
+    """
+    Priority classes for FAExport API requests sharing one upstream budget, from most to least urgent
+    """
+    INTERACTIVE = "interactive"
+    USER_INIT = "user_init"
+    INGEST = "ingest"
+    REFRESH = "refresh"
+
+
+# Priority of the API requests made by the current task, and any tasks it creates. If unset, the client's default is used.
+api_priority: ContextVar[Optional[ApiPriority]] = ContextVar("api_priority", default=None)
@@ -1,32 +1,104 @@
 import asyncio
 import datetime
 import logging
-import uuid
 from typing import Optional, TYPE_CHECKING
 
 from aiolimiter import AsyncLimiter
+from prometheus_client import Gauge
+
+from fa_rss.faexport.priority import ApiPriority, api_priority
 
 if TYPE_CHECKING:
     from fa_rss.faexport.client import FAExportClient
 
 logger = logging.getLogger(__name__)
 
+slowdown_active = Gauge(
+    "farss_faexport_slowdown_active",
+    "Whether FA is currently considered to be in bot slowdown mode (1) or not (0)",
+)
+online_registered_users = Gauge(
+    "farss_faexport_online_registered_users",
+    "Number of registered users online on FA, as of the last status check",
+)
+last_status_check = Gauge(
+    "farss_faexport_last_status_check_unixtime",
+    "Unix timestamp of the last successful FA status check",
+)
 
-class FASlowdownState:
+
+class SlowdownStatusPoller:
+    """
+    Periodically checks the FA status page in the background, to decide whether FA is in bot slowdown mode.
+    Status checks are made through the client which owns the poller, under that client's limits, and stop when it is
+    closed. Clients may share one poller by passing it to each other explicitly.
+    """
     STATUS_LIMIT_REGISTERED = 10_000
 
-    def __init__(self, client: "FAExportClient", limiter: Optional[AsyncLimiter]) -> None:
+    def __init__(
+            self,
+            client: "FAExportClient",
+            check_interval: datetime.timedelta = datetime.timedelta(minutes=5),
+    ) -> None:
+        self.client = client
+        self.check_interval = check_interval
+        self.slowdown_status = False
+        self.online_registered: Optional[int] = None
+        self.last_check: Optional[datetime.datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        # Status checks decide how fast everything else may go, so should not queue behind other requests
+        api_priority.set(ApiPriority.INTERACTIVE)
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.check_interval.total_seconds())
+
+    async def refresh(self) -> None:
+        try:
+            status = await self.client.get_status()
+        except Exception as e:
+            logger.warning("Failed to check FA status for slowdown mode, keeping previous state", exc_info=e)
+            return
+        self.last_check = datetime.datetime.now()
+        self.online_registered = status.online_registered
+        self.slowdown_status = status.online_registered > self.STATUS_LIMIT_REGISTERED
+        online_registered_users.set(status.online_registered)
+        slowdown_active.set(int(self.slowdown_status))
+        last_status_check.set_to_current_time()
+
+
+class FASlowdownState:
+
+    def __init__(
+            self,
+            client: "FAExportClient",
+            limiter: Optional[AsyncLimiter],
+            poller: Optional[SlowdownStatusPoller] = None,
+    ) -> None:
         self.client = client
         self.ignore = False
         # How slow to go when site is in slowdown mode
         self.limiter = limiter
-        # How often to check whether site is in slowdown mode
-        self.last_check: Optional[datetime.datetime] = None
-        self.status_check_backoff = datetime.timedelta(minutes=5)
-        self.slowdown_status = False
+        # Background check of whether site is in slowdown mode, owned by this client unless one was passed in
+        self.poller = poller or SlowdownStatusPoller(client)
 
     async def wait_if_needed(self) -> None:
-        if await self.should_slowdown():
+        if self.should_slowdown():
             logger.debug("FA is in bot slowdown mode, checking rate limit")
             await self.wait()
             logger.debug("Rate limit delay completed")
@@ -35,15 +107,8 @@ class FASlowdownState:
         if self.limiter is not None:
             await self.limiter.acquire()
 
-    async def should_slowdown(self) -> bool:
+    def should_slowdown(self) -> bool:
         if self.ignore:
             return False
-        now = datetime.datetime.now()
-        if (
-            self.last_check is None
-            or (self.last_check + self.status_check_backoff) < now
-        ):
-            status = await self.client.get_status()
-            self.last_check = now
-            self.slowdown_status = status.online_registered > self.STATUS_LIMIT_REGISTERED
-        return self.slowdown_status
+        self.poller.ensure_running()
+        return self.poller.slowdown_status
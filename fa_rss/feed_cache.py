@@ -0,0 +1,223 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Optional, Callable
+
+from prometheus_client import Counter, Gauge
+
+from fa_rss.compression import compress
+from fa_rss.database.database import SFW_RATING
+from fa_rss.database.models import FeedVersion, SubmissionChange
+
+logger = logging.getLogger(__name__)
+
+feed_cache_lookups = Counter(
+    "farss_server_feed_cache_lookup_count",
+    "Number of rendered feed cache lookups, by outcome",
+    ["outcome"],
+)
+feed_cache_invalidations = Counter(
+    "farss_server_feed_cache_invalidation_count",
+    "Number of rendered feeds removed from the cache because submissions in them were saved or deleted",
+)
+feed_cache_evictions = Counter(
+    "farss_server_feed_cache_eviction_count",
+    "Number of rendered feeds evicted from the cache to stay within the size limit",
+)
+feed_cache_skipped = Counter(
+    "farss_server_feed_cache_skipped_count",
+    "Number of rendered feeds not cached, because a submission in them changed while they were being rendered",
+)
+feed_cache_size = Gauge(
+    "farss_server_feed_cache_entries",
+    "Number of rendered feeds currently held in the cache",
+)
+feed_cache_bytes = Gauge(
+    "farss_server_feed_cache_bytes",
+    "Total size of the rendered feeds held in the cache, including their compressed copies",
+)
+
+
+BROWSE_GALLERY = "browse"
+
+
+@dataclass(frozen=True)
+class FeedKey:
+    username: Optional[str]  # None for the browse feed
+    gallery: str
+    sfw_mode: bool
+    feed_length: int
+
+
+@dataclass
+class CachedFeed:
+    body: bytes
+    version: FeedVersion
+    cached_at: float
+    # Compressed copies of the body, by content encoding, created the first time a client asks for each encoding
+    encoded_bodies: dict[str, bytes] = field(default_factory=dict)
+    # Told how many bytes each new compressed copy adds, so that the cache can keep within its size limit
+    on_grow: Optional[Callable[[int], None]] = field(default=None, repr=False, compare=False)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(encoded) for encoded in self.encoded_bodies.values())
+
+    def encoded_body(self, encoding: str) -> bytes:
+        encoded = self.encoded_bodies.get(encoding)
+        if encoded is None:
+            encoded = compress(self.body, encoding)
+            self.encoded_bodies[encoding] = encoded
+            if self.on_grow is not None:
+                self.on_grow(len(encoded))
+        return encoded
+
+
+class FeedCache:
+    """
+    Least-recently-used cache of rendered RSS feeds, bounded by the total size of the feeds and their compressed copies,
+    and invalidated whenever a submission which could appear in a cached feed is saved to or deleted from the
+    database, by any process.
+    A feed is only cached if no change to it was notified while it was being rendered, which callers check by taking
+    the generation before querying the database, and passing it to set(). Entries also expire after max_age seconds,
+    in case a change notification is lost.
+    """
+    # How many recent changes to remember, for checking feeds which were rendered while they arrived
+    RECENT_CHANGES = 1_000
+
+    def __init__(self, max_bytes: int = 50 * 1024 * 1024, max_age: float = 600) -> None:
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries: OrderedDict[FeedKey, CachedFeed] = OrderedDict()
+        self._size_bytes = 0
+        # Incremented by every change notification. Recent changes are kept with the generation they started.
+        self.generation = 0
+        self._recent_changes: deque[tuple[int, SubmissionChange]] = deque(maxlen=self.RECENT_CHANGES)
+
+    @staticmethod
+    def user_key(username: str, gallery: str, sfw_mode: bool, feed_length: int) -> FeedKey:
+        return FeedKey(username.lower(), gallery, sfw_mode, feed_length)
+
+    @staticmethod
+    def browse_key(sfw_mode: bool, feed_length: int) -> FeedKey:
+        return FeedKey(None, BROWSE_GALLERY, sfw_mode, feed_length)
+
+    def get(self, key: FeedKey) -> Optional[CachedFeed]:
+        entry = self._entries.get(key)
+        if entry is None:
+            feed_cache_lookups.labels(outcome="miss").inc()
+            return None
+        if entry.cached_at + self.max_age < time.monotonic():
+            feed_cache_lookups.labels(outcome="expired").inc()
+            self._remove(key)
+            self._update_size_metrics()
+            return None
+        feed_cache_lookups.labels(outcome="hit").inc()
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: FeedKey, body: bytes, version: FeedVersion, generation: int) -> CachedFeed:
+        """
+        Caches a rendered feed, unless a change since the given generation could affect it, and returns the entry to
+        respond with either way
+        """
+        entry = CachedFeed(body, version, time.monotonic())
+        if self._changed_since(key, version, generation):
+            feed_cache_skipped.inc()
+            return entry
+        if len(body) > self.max_bytes:
+            return entry
+        self._remove(key)
+        entry.on_grow = lambda added: self._on_entry_grown(key, entry, added)
+        self._entries[key] = entry
+        self._size_bytes += entry.size
+        self._evict()
+        return entry
+
+    def _remove(self, key: FeedKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size_bytes -= entry.size
+
+    def _on_entry_grown(self, key: FeedKey, entry: CachedFeed, added: int) -> None:
+        # The entry may have been invalidated while a request was still responding with it
+        if self._entries.get(key) is not entry:
+            return
+        self._size_bytes += added
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._size_bytes > self.max_bytes and self._entries:
+            evicted_key = next(iter(self._entries))
+            self._remove(evicted_key)
+            feed_cache_evictions.inc()
+        self._update_size_metrics()
+
+    def _update_size_metrics(self) -> None:
+        feed_cache_size.set(len(self._entries))
+        feed_cache_bytes.set(self._size_bytes)
+
+    def _changed_since(self, key: FeedKey, version: FeedVersion, generation: int) -> bool:
+        if generation == self.generation:
+            return False
+        # If the changes since then are no longer all remembered, assume the feed was affected
+        if len(self._recent_changes) < self.generation - generation:
+            return True
+        return any(
+            self._affected_by(key, version, change)
+            for change_generation, change in self._recent_changes
+            if change_generation >= generation
+        )
+
+    @classmethod
+    def _affected_by(cls, key: FeedKey, version: FeedVersion, submission: SubmissionChange) -> bool:
+        # A submission which moved gallery or changed rating affects the feeds it left, as well as those it joined
+        return any(
+            cls._placement_affects(key, version, submission, gallery, rating)
+            for gallery, rating in submission.placements()
+        )
+
+    @staticmethod
+    def _placement_affects(
+            key: FeedKey,
+            version: FeedVersion,
+            submission: SubmissionChange,
+            gallery: str,
+            rating: str,
+    ) -> bool:
+        if key.username is not None:
+            if key.username != submission.username.lower() or key.gallery != gallery:
+                return False
+        if key.sfw_mode and rating != SFW_RATING:
+            return False
+        # If the feed is not full, any new submission belongs in it
+        feed_is_full = version.submission_count >= key.feed_length
+        if feed_is_full and submission.submission_id < version.oldest_submission_id:
+            return False
+        return True
+
+    def on_submission_changed(self, submission: SubmissionChange) -> None:
+        self._recent_changes.append((self.generation, submission))
+        self.generation += 1
+        stale_keys = [
+            key for key, entry in self._entries.items()
+            if self._affected_by(key, entry.version, submission)
+        ]
+        for key in stale_keys:
+            self._remove(key)
+        if stale_keys:
+            logger.debug("Invalidated %s cached feeds", len(stale_keys))
+            feed_cache_invalidations.inc(len(stale_keys))
+            self._update_size_metrics()
+
+    def clear(self) -> None:
+        if self._entries:
+            logger.info("Clearing %s cached feeds", len(self._entries))
+            feed_cache_invalidations.inc(len(self._entries))
+        self._entries.clear()
+        self._size_bytes = 0
+        # Changes may have been missed, so feeds being rendered now should not be cached either
+        self._recent_changes.clear()
+        self.generation += 1
+        self._update_size_metrics()
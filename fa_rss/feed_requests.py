@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Optional
+
+from fa_rss.database.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class FeedRequestTracker:
+    """
+    Counts feed requests per user in memory, and periodically flushes the counts to the database, so that the refresh
+    scheduler knows which galleries are actually being read, without adding a database write to every feed request.
+    """
+    FLUSH_INTERVAL_SECONDS = 60
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        self._counts: Counter[str] = Counter()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, username: str) -> None:
+        self._counts[username.lower()] += 1
+
+    async def flush(self) -> None:
+        if not self._counts:
+            return
+        counts, self._counts = self._counts, Counter()
+        try:
+            await self.db.record_feed_requests(dict(counts))
+        except Exception as e:
+            logger.warning("Failed to record feed requests, will try again next flush", exc_info=e)
+            self._counts.update(counts)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL_SECONDS)
+            await self.flush()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
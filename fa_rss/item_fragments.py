@@ -0,0 +1,91 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from jinja2 import Environment
+from markupsafe import Markup
+from prometheus_client import Counter, Gauge
+
+from fa_rss.feed_item import FeedItem, FeedItemFull
+
+logger = logging.getLogger(__name__)
+
+fragment_cache_lookups = Counter(
+    "farss_server_item_fragment_cache_lookup_count",
+    "Number of rendered RSS item fragment cache lookups, by outcome",
+    ["outcome"],
+)
+fragment_cache_bytes = Gauge(
+    "farss_server_item_fragment_cache_bytes",
+    "Total size of the rendered RSS item fragments held in the cache",
+)
+
+
+class ItemFragmentCache:
+    """
+    Renders each submission's RSS <item> once, and keeps the rendered fragment, so that feeds can be assembled by
+    concatenating fragments rather than re-rendering every description on every request.
+    Fragments are keyed by the submission's contents and a hash of the item templates, so an edited submission or an
+    updated template is rendered afresh. The templates are only read on first use, so that importing the app does not
+    need them. The cache is bounded by the total size of its fragments, as descriptions vary widely in length.
+    """
+    ITEM_TEMPLATE = "feed_submission.rss.jinja2"
+    DESCRIPTION_TEMPLATE = "feed_submission_description.html.jinja2"
+
+    def __init__(self, jinja_env: Environment, max_bytes: int = 20 * 1024 * 1024) -> None:
+        self.jinja_env = jinja_env
+        self.max_bytes = max_bytes
+        self._size_bytes = 0
+        self._template_version: Optional[str] = None
+        self._fragments: OrderedDict[tuple[int, int, str], Markup] = OrderedDict()
+
+    @property
+    def template_version(self) -> str:
+        if self._template_version is None:
+            self._template_version = self._template_hash()
+        return self._template_version
+
+    def _template_hash(self) -> str:
+        template_hash = hashlib.sha1()
+        for template_name in [self.ITEM_TEMPLATE, self.DESCRIPTION_TEMPLATE]:
+            source, _, _ = self.jinja_env.loader.get_source(self.jinja_env, template_name)
+            template_hash.update(source.encode())
+        return template_hash.hexdigest()
+
+    async def _render(self, item: FeedItem) -> Markup:
+        template = self.jinja_env.get_template(self.ITEM_TEMPLATE)
+        module = await template.make_module_async()
+        return await module.render_submission(item)
+
+    async def render(self, item: FeedItem) -> Markup:
+        # Preview items are only shown until the user is initialised, so are not worth keeping
+        if not isinstance(item, FeedItemFull):
+            return await self._render(item)
+        submission = item.submission
+        content_hash = hash((
+            submission.username,
+            submission.title,
+            submission.description,
+            submission.download_url,
+            submission.thumbnail_url,
+            submission.posted_at,
+            tuple(submission.keywords),
+        ))
+        key = (submission.submission_id, content_hash, self.template_version)
+        fragment = self._fragments.get(key)
+        if fragment is not None:
+            fragment_cache_lookups.labels(outcome="hit").inc()
+            self._fragments.move_to_end(key)
+            return fragment
+        fragment_cache_lookups.labels(outcome="miss").inc()
+        fragment = await self._render(item)
+        if len(fragment) > self.max_bytes or key in self._fragments:
+            return fragment
+        self._fragments[key] = fragment
+        self._size_bytes += len(fragment)
+        while self._size_bytes > self.max_bytes:
+            _, evicted = self._fragments.popitem(last=False)
+            self._size_bytes -= len(evicted)
+        fragment_cache_bytes.set(self._size_bytes)
+        return fragment
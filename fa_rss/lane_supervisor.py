@@ -0,0 +1,45 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+lane_restarts = Counter(
+    "farss_datafetcher_lane_restart_count",
+    "Number of times a data fetcher lane was restarted after failing with an unexpected error",
+    ["lane"],
+)
+
+
+class LaneSupervisor:
+    """
+    Runs one of the data fetcher's lanes, such as ingestion or gallery refreshes, restarting it with a backoff whenever
+    it fails with an unexpected error, so that a failure in one lane does not stop the others.
+    The backoff doubles with each consecutive failure, and resets once the lane has stayed up for a while.
+    """
+    INITIAL_BACKOFF_SECONDS = 5
+    MAX_BACKOFF_SECONDS = 5*60
+    HEALTHY_RUN_SECONDS = 10*60
+
+    def __init__(self, name: str, run_lane: Callable[[], Awaitable[None]]) -> None:
+        self.name = name
+        self.run_lane = run_lane
+
+    async def run(self) -> None:
+        backoff = self.INITIAL_BACKOFF_SECONDS
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_lane()
+                # Lanes only return when asked to stop
+                return
+            except Exception as e:
+                if time.monotonic() - started > self.HEALTHY_RUN_SECONDS:
+                    backoff = self.INITIAL_BACKOFF_SECONDS
+                logger.error("Data fetcher lane %s failed, restarting in %s seconds", self.name, backoff, exc_info=e)
+                lane_restarts.labels(lane=self.name).inc()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_BACKOFF_SECONDS)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from typing import Optional
+
+import psycopg
+from prometheus_client import Gauge, Counter
+
+from fa_rss.database.database import Database
+from fa_rss.database.models import SubmissionPartition
+from fa_rss.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+partition_count = Gauge(
+    "farss_database_submission_partitions",
+    "Number of partitions of the submissions table, by whether they have been compacted by the retention policy",
+    ["retained"],
+)
+partition_upper_bound = Gauge(
+    "farss_database_submission_partition_upper_bound",
+    "Upper bound of the newest submissions partition, beyond which submissions cannot yet be saved",
+)
+partitions_compacted = Counter(
+    "farss_database_submission_partitions_compacted_count",
+    "Count of cold submission partitions compacted by the retention policy",
+)
+submissions_retained = Counter(
+    "farss_database_submissions_retained_count",
+    "Count of submissions kept from cold partitions, as they are still among the newest in their user's gallery",
+)
+
+
+class PartitionManager:
+    """
+    Maintains the submissions table's range partitions. New partitions are created ahead of the latest submission ID,
+    so that ingestion never reaches an ID with no partition for it. If retention is enabled, cold partitions, beyond the
+    newest few, are compacted down to the submissions still shown in users' gallery feeds, and the full partitions are
+    archived or dropped.
+    """
+    DEFAULT_PARTITION_SIZE = 1_000_000
+    DEFAULT_HOT_PARTITIONS = 3
+    # How many partitions to keep ready beyond the one holding the latest submission ID
+    LOOKAHEAD_PARTITIONS = 1
+    MAINTENANCE_INTERVAL_SECONDS = 10*60
+
+    def __init__(
+            self,
+            db: Database,
+            *,
+            partition_size: int = DEFAULT_PARTITION_SIZE,
+            hot_partitions: int = DEFAULT_HOT_PARTITIONS,
+            retention: bool = False,
+            drop_archived: bool = False,
+    ) -> None:
+        self.running = False
+        self.db = db
+        self.settings = Settings(db)
+        self.partition_size = partition_size
+        self.hot_partitions = hot_partitions
+        self.retention = retention
+        self.drop_archived = drop_archived
+        self._upper_bound: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    async def run(self) -> None:
+        self.running = True
+        while self.running:
+            try:
+                await self.run_maintenance()
+            except psycopg.Error as e:
+                logger.warning("Failed to maintain submission partitions, will try again later", exc_info=e)
+            await asyncio.sleep(self.MAINTENANCE_INTERVAL_SECONDS)
+
+    async def run_maintenance(self) -> None:
+        latest_id = await self.ensure_partitions_for_latest()
+        if self.retention and latest_id is not None:
+            await self.apply_retention(latest_id)
+        await self._update_metrics()
+
+    async def ensure_partitions_for_latest(self) -> Optional[int]:
+        latest_id = await self.settings.get_latest_submission_id()
+        if latest_id is not None:
+            await self.ensure_partitions(latest_id)
+        return latest_id
+
+    async def ensure_partitions(self, latest_submission_id: int) -> None:
+        """
+        Creates any partitions needed to hold submissions up to the given ID, plus the lookahead. Any range skipped
+        while the data fetcher was not running is covered by a single catch-up partition.
+        """
+        target_upper = (latest_submission_id // self.partition_size + 1 + self.LOOKAHEAD_PARTITIONS) * self.partition_size
+        # Only check the database when the known partitions may not be enough
+        if self._upper_bound is not None and self._upper_bound >= target_upper:
+            return
+        async with self._lock:
+            partitions = await self.db.list_submission_partitions()
+            lower = max((partition.upper_bound for partition in partitions if partition.upper_bound is not None), default=0)
+            while lower < target_upper:
+                upper = max(
+                    (lower // self.partition_size + 1) * self.partition_size,
+                    (latest_submission_id // self.partition_size) * self.partition_size,
+                )
+                await self.db.create_submission_partition(lower, upper)
+                lower = upper
+            self._upper_bound = lower
+            partition_upper_bound.set(lower)
+
+    def _cold_partitions(self, partitions: list[SubmissionPartition], latest_submission_id: int) -> list[SubmissionPartition]:
+        filled = [
+            partition for partition in partitions
+            if partition.lower_bound is None or partition.lower_bound <= latest_submission_id
+        ]
+        cold = filled[:max(len(filled) - self.hot_partitions, 0)]
+        return [partition for partition in cold if not partition.is_retained]
+
+    async def apply_retention(self, latest_submission_id: int) -> None:
+        partitions = await self.db.list_submission_partitions()
+        cold_partitions = self._cold_partitions(partitions, latest_submission_id)
+        if not cold_partitions:
+            return
+        feed_length = await self.settings.get_feed_length()
+        for partition in cold_partitions:
+            logger.info("Compacting cold submission partition: %s", partition.name)
+            retained_count = await self.db.compact_submission_partition(
+                partition,
+                feed_length,
+                drop_archived=self.drop_archived,
+            )
+            logger.info("Compacted submission partition %s, retaining %s submissions", partition.name, retained_count)
+            partitions_compacted.inc()
+            submissions_retained.inc(retained_count)
+
+    async def _update_metrics(self) -> None:
+        partitions = await self.db.list_submission_partitions()
+        retained_count = len([partition for partition in partitions if partition.is_retained])
+        partition_count.labels(retained="true").set(retained_count)
+        partition_count.labels(retained="false").set(len(partitions) - retained_count)
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+poll_interval = Gauge(
+    "farss_datafetcher_poll_interval_seconds",
+    "Current interval between the data watcher's polls for the latest submission ID",
+)
+arrival_rate = Gauge(
+    "farss_datafetcher_submission_arrival_rate",
+    "Estimated rate at which new submissions are being posted to FA, in submission IDs per second",
+)
+
+
+class PollScheduler:
+    """
+    Decides how long the data watcher waits between polls for the latest submission ID, from an estimate of how fast new
+    submissions are arriving. Each poll aims to find about target_new_ids new submissions, so polls come quickly while
+    FA is busy and back off while it is quiet, within the configured bounds.
+    The arrival rate is an exponentially weighted average of the new IDs per second seen at each poll. Intervals are
+    counted from the start of the previous poll, so time spent ingesting a batch counts towards the wait.
+    """
+    DEFAULT_MIN_INTERVAL_SECONDS = 2
+    DEFAULT_MAX_INTERVAL_SECONDS = 60
+    DEFAULT_TARGET_NEW_IDS = 10
+    DEFAULT_SMOOTHING = 0.3
+
+    def __init__(
+            self,
+            *,
+            min_interval: float = DEFAULT_MIN_INTERVAL_SECONDS,
+            max_interval: float = DEFAULT_MAX_INTERVAL_SECONDS,
+            target_new_ids: float = DEFAULT_TARGET_NEW_IDS,
+            smoothing: float = DEFAULT_SMOOTHING,
+    ) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_new_ids = target_new_ids
+        self.smoothing = smoothing
+        self.arrival_rate: Optional[float] = None
+        self._last_poll: Optional[float] = None
+        self._last_latest_id: Optional[int] = None
+        poll_interval.set(self.interval())
+
+    def interval(self) -> float:
+        # Poll quickly until there is an estimate to go on
+        if self.arrival_rate is None:
+            return self.min_interval
+        if self.arrival_rate <= 0:
+            return self.max_interval
+        return min(max(self.target_new_ids / self.arrival_rate, self.min_interval), self.max_interval)
+
+    def record_poll(self, latest_id: int) -> None:
+        now = time.monotonic()
+        if self._last_poll is not None and self._last_latest_id is not None and now > self._last_poll:
+            # The home page can briefly show an older latest ID, which is not a negative arrival rate
+            new_ids = max(latest_id - self._last_latest_id, 0)
+            rate = new_ids / (now - self._last_poll)
+            if self.arrival_rate is None:
+                self.arrival_rate = rate
+            else:
+                self.arrival_rate = self.smoothing * rate + (1 - self.smoothing) * self.arrival_rate
+            arrival_rate.set(self.arrival_rate)
+        self._last_poll = now
+        self._last_latest_id = max(latest_id, self._last_latest_id or latest_id)
+        poll_interval.set(self.interval())
+
+    async def wait(self) -> None:
+        if self._last_poll is None:
+            return
+        remaining = self._last_poll + self.interval() - time.monotonic()
+        if remaining > 0:
+            logger.debug("Waiting %.1f seconds before polling for new submissions", remaining)
+            await asyncio.sleep(remaining)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+from prometheus_client import Counter
+
+from fa_rss.database.database import Database
+from fa_rss.database.models import User
+from fa_rss.faexport.adaptive_limiter import AdaptiveLimiter
+from fa_rss.faexport.client import FAExportClient
+from fa_rss.faexport.errors import SubmissionNotFound, FAUserDisabled, UserNotFound, FAExportError
+from fa_rss.faexport.models import Submission
+from fa_rss.faexport.priority import ApiPriority, api_priority
+from fa_rss.settings import Settings
+
+refresh_users_count = Counter(
+    "farss_refresh_users_count",
+    "Count of user galleries refreshed by the refresh scheduler",
+)
+refresh_updated_submissions = Counter(
+    "farss_refresh_updated_submissions_count",
+    "Count of submissions which the refresh scheduler found to be new or changed, and saved",
+)
+refresh_deleted_submissions = Counter(
+    "farss_refresh_deleted_submissions_count",
+    "Count of submissions which the refresh scheduler found to be deleted from FA, and removed",
+)
+refresh_abandoned_count = Counter(
+    "farss_refresh_abandoned_count",
+    "Count of user gallery refreshes given up on after failing repeatedly, until the user is next due a refresh",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """
+    Periodically re-lists the galleries of users whose feeds are being requested, to pick up new, edited, and deleted
+    submissions. API requests are paced to a fixed share of the fetcher's current adaptive rate, so refreshing backs off
+    along with it and leaves the rest for ingesting new submissions. They also take the lowest priority in the shared
+    API budget, so refreshes are the first thing held back when other processes need the API.
+    """
+    MIN_REFRESH_INTERVAL_SECONDS = 6*60*60
+    IDLE_POLL_SECONDS = 60
+    ERROR_BACKOFF_SECONDS = 60
+    MAX_REFRESH_FAILURES = 5
+    REFRESH_RETRY_BACKOFF_SECONDS = 5*60
+    # How many of the newest submissions to re-fetch on each refresh, as descriptions are often edited soon after posting
+    REFETCH_DEPTH = 3
+
+    def __init__(
+            self,
+            database: Database,
+            api: FAExportClient,
+            *,
+            rate_limiter: AdaptiveLimiter,
+            budget_share: float,
+    ) -> None:
+        self.running = False
+        self.db = database
+        self.settings = Settings(database)
+        self.api = api
+        self.rate_limiter = rate_limiter
+        self.budget_share = budget_share
+        self._next_request_at = 0.0
+
+    async def _wait_for_share(self) -> None:
+        # The interval is taken from the rate at the time, so pacing follows the adaptive limiter as it changes
+        now = time.monotonic()
+        slot = max(now, self._next_request_at)
+        self._next_request_at = slot + 1 / (self.rate_limiter.rate * self.budget_share)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def run(self) -> None:
+        self.running = True
+        api_priority.set(ApiPriority.REFRESH)
+        while self.running:
+            user = await self.db.get_user_to_refresh(self.MIN_REFRESH_INTERVAL_SECONDS)
+            if user is None:
+                await asyncio.sleep(self.IDLE_POLL_SECONDS)
+                continue
+            try:
+                await self.refresh_user(user)
+            except (UserNotFound, FAUserDisabled):
+                logger.info("User no longer available on FA, skipping refresh: %s", user.username)
+                await self.db.mark_user_refreshed(user)
+            except (FAExportError, aiohttp.ClientError, TimeoutError) as e:
+                logger.warning("Failed to refresh user gallery, waiting before retry", exc_info=e)
+                await self._back_off_user(user, e)
+                await asyncio.sleep(self.ERROR_BACKOFF_SECONDS)
+            except Exception as e:
+                # Any other failure is likely down to this user's data, so back them off and carry on with others
+                logger.warning("Failed to refresh user gallery: %s", user.username, exc_info=e)
+                await self._back_off_user(user, e)
+
+    async def _back_off_user(self, user: User, error: Exception) -> None:
+        # Otherwise the same user would be picked again next, holding up everyone else's refreshes
+        failures = user.refresh_failures + 1
+        if failures >= self.MAX_REFRESH_FAILURES:
+            logger.error("Refresh failed %s times, skipping until next interval: %s", failures, user.username, exc_info=error)
+            refresh_abandoned_count.inc()
+            await self.db.mark_user_refreshed(user)
+            return
+        retry_delay = self.REFRESH_RETRY_BACKOFF_SECONDS * 2 ** (failures - 1)
+        await self.db.retry_user_refresh(user, retry_delay)
+
+    async def refresh_user(self, user: User) -> None:
+        logger.info("Refreshing user: %s", user.username)
+        feed_length = await self.settings.get_feed_length()
+        for gallery in ["gallery", "scraps"]:
+            await self._refresh_gallery(user.username, gallery, feed_length)
+        await self.db.mark_user_refreshed(user)
+        refresh_users_count.inc()
+
+    async def _refresh_gallery(self, username: str, gallery: str, feed_length: int) -> None:
+        await self._wait_for_share()
+        if gallery == "gallery":
+            listing = await self.api.get_gallery_full(username)
+        else:
+            listing = await self.api.get_scraps_full(username)
+        listed = {preview.submission_id: preview for preview in listing[:feed_length]}
+        stored = await self.db.list_submissions_by_user_gallery(username, gallery, limit=feed_length)
+        stored_by_id = {sub.submission_id: sub for sub in stored}
+        # Fetch listed submissions which are missing from the database, or have changed title
+        refetch_ids = {
+            sub_id for sub_id, preview in listed.items()
+            if sub_id not in stored_by_id or stored_by_id[sub_id].title != preview.title
+        }
+        # Also re-fetch the newest submissions, whose descriptions are the most likely to have been edited
+        refetch_ids.update(sorted(listed, reverse=True)[:self.REFETCH_DEPTH])
+        # Stored submissions which are newer than the end of the listing, but not in it, may have been deleted or moved
+        oldest_listed = min(listed, default=0)
+        refetch_ids.update(
+            sub.submission_id for sub in stored
+            if sub.submission_id not in listed and sub.submission_id > oldest_listed
+        )
+        updated: list[Submission] = []
+        for sub_id in sorted(refetch_ids):
+            await self._wait_for_share()
+            try:
+                submission = await self.api.get_submission(sub_id)
+            except (SubmissionNotFound, FAUserDisabled):
+                if sub_id in stored_by_id:
+                    logger.info("Removing deleted submission: %s", sub_id)
+                    await self.db.delete_submission(stored_by_id[sub_id])
+                    refresh_deleted_submissions.inc()
+                continue
+            if stored_by_id.get(sub_id) != submission:
+                updated.append(submission)
+        if updated:
+            await self.db.save_submissions(updated)
+            refresh_updated_submissions.inc(len(updated))
@@ -0,0 +1,33 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class RequestTimer:
+    """
+    Records how long each phase of handling a request takes, for the Server-Timing header and the slow request log.
+    Phases which happen more than once in a request have their durations summed.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        phase_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - phase_start
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def server_timing_header(self) -> str:
+        metrics = [f"{name};dur={duration * 1000:.1f}" for name, duration in self.phases.items()]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def breakdown(self) -> str:
+        return " ".join(f"{name}={duration * 1000:.1f}ms" for name, duration in self.phases.items())
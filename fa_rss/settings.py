@@ -1,21 +1,64 @@
+import json
+import time
 from typing import Optional
 
 from fa_rss.database.database import Database
+from fa_rss.database.models import SubmissionGap
+from fa_rss.database.notifications import NotificationListener, SETTINGS_CHANGED
+from fa_rss.faexport.models import Submission
 
 
 class Settings:
+    """
+    Reads and writes settings, caching the values read. If given a notification listener, the cache is kept up to date
+    by change notifications, and is reloaded whenever the listener reconnects. Otherwise, or while the listener is
+    disconnected, cached values are re-read after a short time.
+    The latest submission ID is always read from the database, as the data fetcher relies on it being current.
+    """
     FEED_LENGTH = "feed_length"
     DEFAULT_FEED_LENGTH = 20
     LATEST_SUBMISSION_ID = "latest_submission_id"
+    CACHE_MAX_AGE_SECONDS = 30
 
-    def __init__(self, db: Database) -> None:
+    def __init__(self, db: Database, listener: Optional[NotificationListener] = None) -> None:
         self.db = db
+        self.listener = listener
+        self._cache: dict[str, tuple[Optional[str], float]] = {}
+        if listener is not None:
+            listener.add_handler(SETTINGS_CHANGED, self._on_setting_changed)
+            listener.add_reconnect_handler(self.reload)
+
+    async def reload(self) -> None:
+        values = await self.db.list_setting_values()
+        now = time.monotonic()
+        self._cache = {setting_key: (setting_value, now) for setting_key, setting_value in values.items()}
+
+    def _on_setting_changed(self, payload: str) -> None:
+        change = json.loads(payload)
+        self._cache[change["key"]] = (change["value"], time.monotonic())
+
+    async def _get_cached_value(self, setting_key: str) -> Optional[str]:
+        cached = self._cache.get(setting_key)
+        if cached is not None:
+            setting_value, cached_at = cached
+            # While notifications are being received, the cache is always up to date
+            if self.listener is not None and self.listener.connected:
+                return setting_value
+            if cached_at + self.CACHE_MAX_AGE_SECONDS > time.monotonic():
+                return setting_value
+        setting_value = await self.db.get_setting_value(setting_key)
+        self._cache[setting_key] = (setting_value, time.monotonic())
+        return setting_value
+
+    async def _set_value(self, setting_key: str, setting_value: str) -> None:
+        await self.db.set_setting_value(setting_key, setting_value)
+        self._cache[setting_key] = (setting_value, time.monotonic())
 
     async def get_feed_length(self) -> int:
-        feed_length = await self.db.get_setting_value(self.FEED_LENGTH)
+        feed_length = await self._get_cached_value(self.FEED_LENGTH)
         if feed_length:
             return int(feed_length)
-        await self.db.set_setting_value(self.FEED_LENGTH, self.DEFAULT_FEED_LENGTH)
+        await self._set_value(self.FEED_LENGTH, f"{self.DEFAULT_FEED_LENGTH}")
         return self.DEFAULT_FEED_LENGTH
 
     async def get_latest_submission_id(self) -> Optional[int]:
@@ -25,4 +68,16 @@ class Settings:
         return None
 
     async def update_latest_submission_id(self, submission_id: int) -> None:
-        await self.db.set_setting_value(self.LATEST_SUBMISSION_ID, f"{submission_id}")
+        await self._set_value(self.LATEST_SUBMISSION_ID, f"{submission_id}")
+
+    async def save_ingested_submissions(
+            self,
+            submissions: list[Submission],
+            gaps: list[SubmissionGap],
+            latest_submission_id: int,
+    ) -> None:
+        await self.db.save_submissions(
+            submissions,
+            new_gaps=gaps,
+            setting_updates={self.LATEST_SUBMISSION_ID: f"{latest_submission_id}"},
+        )
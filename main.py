@@ -5,32 +5,165 @@ import sys
 from aiolimiter import AsyncLimiter
 from prometheus_client import start_http_server
 
-from fa_rss.app import app
+from fa_rss.api_budget import SharedApiBudget
 from fa_rss.data_fetcher import DataFetcher
 from fa_rss.database.database import Database
+from fa_rss.database.migrator import Migrator
+from fa_rss.database.query_plans import check_feed_query_plans
+from fa_rss.faexport.adaptive_limiter import AdaptiveLimiter
 from fa_rss.faexport.client import FAExportClient
+from fa_rss.lane_supervisor import LaneSupervisor
+from fa_rss.partition_manager import PartitionManager
+from fa_rss.poll_scheduler import PollScheduler
+from fa_rss.refresh_scheduler import RefreshScheduler
 
+# Requests per second which the background data fetcher starts off making to the FAExport API
+API_RATE_LIMIT = 1
 
-def start_data_watcher() -> None:
+
+def load_config() -> dict:
     with open("config.json") as f:
-        conf = json.load(f)
+        return json.load(f)
+
+
+def build_fetcher(conf: dict) -> DataFetcher:
     db = Database(conf["database"])
+    rate_conf = conf["faexport"].get("rate_limit", {})
     api = FAExportClient(
         conf["faexport"]["url"],
-        limiter=AsyncLimiter(1, 1),
+        limiter=AdaptiveLimiter(
+            "fetcher",
+            initial_rate=rate_conf.get("initial", API_RATE_LIMIT),
+            min_rate=rate_conf.get("min", API_RATE_LIMIT / 5),
+            max_rate=rate_conf.get("max", API_RATE_LIMIT * 2),
+        ),
         slowdown_limiter=AsyncLimiter(1, 1),
+        budget=SharedApiBudget(
+            db,
+            rate=conf.get("api_budget", {}).get("requests_per_second", SharedApiBudget.DEFAULT_RATE),
+            burst=conf.get("api_budget", {}).get("burst", SharedApiBudget.DEFAULT_BURST),
+        ),
         max_attempts=15,
+        connection_limit=conf["faexport"].get("connection_limit", 20),
+        connection_limit_per_host=conf["faexport"].get("connection_limit_per_host", 10),
+        request_timeout=conf["faexport"].get("request_timeout_seconds", 120),
+    )
+    partitions_conf = conf.get("partitions", {})
+    poll_conf = conf.get("data_fetcher", {}).get("poll", {})
+    partition_manager = PartitionManager(
+        db,
+        partition_size=partitions_conf.get("partition_size", PartitionManager.DEFAULT_PARTITION_SIZE),
+        hot_partitions=partitions_conf.get("hot_partitions", PartitionManager.DEFAULT_HOT_PARTITIONS),
+        retention=partitions_conf.get("retention", False),
+        drop_archived=partitions_conf.get("drop_archived", False),
+    )
+    return DataFetcher(
+        db,
+        api,
+        ingest_workers=conf.get("data_fetcher", {}).get("ingest_workers", DataFetcher.DEFAULT_INGEST_WORKERS),
+        partition_manager=partition_manager,
+        poll_scheduler=PollScheduler(
+            min_interval=poll_conf.get("min_interval_seconds", PollScheduler.DEFAULT_MIN_INTERVAL_SECONDS),
+            max_interval=poll_conf.get("max_interval_seconds", PollScheduler.DEFAULT_MAX_INTERVAL_SECONDS),
+            target_new_ids=poll_conf.get("target_new_ids", PollScheduler.DEFAULT_TARGET_NEW_IDS),
+        ),
+    )
+
+
+def start_data_watcher() -> None:
+    conf = load_config()
+    fetcher = build_fetcher(conf)
+    # The data fetcher also drains the user initialisation queue, unless that is left to dedicated workers
+    user_init_workers = conf.get("data_fetcher", {}).get("user_init_workers", DataFetcher.DEFAULT_USER_INIT_WORKERS)
+    # Gallery refreshes only get a share of the fetcher's current API rate, so they never starve new submission ingestion
+    refresh_scheduler = RefreshScheduler(
+        fetcher.db,
+        fetcher.api,
+        rate_limiter=fetcher.api.limiter,
+        budget_share=conf.get("refresh", {}).get("budget_share", 0.2),
     )
     start_http_server(80)
-    fetcher = DataFetcher(db, api)
-    asyncio.get_event_loop().run_until_complete(fetcher.run_data_watcher())
+    asyncio.get_event_loop().run_until_complete(run_fetcher(
+        fetcher,
+        LaneSupervisor("data_watcher", fetcher.run_data_watcher),
+        LaneSupervisor("gap_retrier", fetcher.run_gap_retrier),
+        LaneSupervisor("user_init", lambda: fetcher.run_user_init_workers(user_init_workers)),
+        LaneSupervisor("refresh", refresh_scheduler.run),
+        LaneSupervisor("partitions", fetcher.partition_manager.run),
+    ))
+
+
+def start_user_init_worker() -> None:
+    conf = load_config()
+    fetcher = build_fetcher(conf)
+    user_init_workers = conf.get("user_init_worker", {}).get("workers", DataFetcher.DEFAULT_USER_INIT_WORKERS)
+    start_http_server(80)
+    asyncio.get_event_loop().run_until_complete(run_fetcher(
+        fetcher,
+        LaneSupervisor("user_init", lambda: fetcher.run_user_init_workers(user_init_workers)),
+    ))
+
+
+async def run_fetcher(fetcher: DataFetcher, *lanes: LaneSupervisor) -> None:
+    await fetcher.db.open()
+    try:
+        await Migrator(fetcher.db).migrate()
+        # Ensure partitions exist for the latest known submissions before anything tries to save them
+        await fetcher.partition_manager.ensure_partitions_for_latest()
+        await asyncio.gather(*[lane.run() for lane in lanes])
+    finally:
+        await fetcher.api.close()
+        await fetcher.db.close()
+
+
+def run_migrations() -> None:
+    conf = load_config()
+    asyncio.get_event_loop().run_until_complete(_run_migrations(Database(conf["database"])))
+
+
+async def _run_migrations(db: Database) -> None:
+    await db.open()
+    try:
+        await Migrator(db).migrate()
+    finally:
+        await db.close()
+
+
+def check_query_plans() -> None:
+    conf = load_config()
+    problems = asyncio.get_event_loop().run_until_complete(_check_query_plans(Database(conf["database"])))
+    if problems:
+        for problem in problems:
+            print(f"Query plan check failed: {problem}")
+        sys.exit(1)
+    print("All feed queries are served by their indexes")
+
+
+async def _check_query_plans(db: Database) -> list[str]:
+    await db.open()
+    try:
+        # A check must not change the database it checks, so refuse to run until migrations have been applied elsewhere
+        pending = await Migrator(db).list_pending_migrations()
+        if pending:
+            return [f"Database migration {migration.version}_{migration.name} has not been applied" for migration in pending]
+        return await check_feed_query_plans(db)
+    finally:
+        await db.close()
 
 
 if __name__ == '__main__':
     cmd = sys.argv[1]
     if cmd == "data_fetcher":
         start_data_watcher()
+    elif cmd == "user_init_worker":
+        start_user_init_worker()
     elif cmd == "server":
+        # Only the server needs the app, and its templates
+        from fa_rss.app import app
         app.run()
+    elif cmd == "migrate":
+        run_migrations()
+    elif cmd == "check_query_plans":
+        check_query_plans()
     else:
         raise ValueError(f"Unrecognised command: {cmd}")